@@ -2,10 +2,25 @@ import struct
 import os
 import gzip
 import io
+import zlib
+import concurrent.futures
 
 import lz4.frame
 
-from .common import MAGIC, FLAG_GZIP, FLAG_LZ4, HEADER_PADDING_LEN
+from .common import (
+    MAGIC,
+    FLAG_GZIP,
+    FLAG_LZ4,
+    FLAG_CHUNKED,
+    FLAG_SPLIT,
+    HEADER_PADDING_LEN,
+)
+
+# Content of chunked members is read, and their blocks are emitted, in
+# pieces of about this size.
+BLOCK_SIZE = 1024 * 1024
+
+BLOCK_TERMINATOR = struct.pack("<L", 0)
 
 
 def _get_length(content):
@@ -18,26 +33,55 @@ def _get_length(content):
 
 
 class TransformWrapper:
-    def __init__(self, data, retain_cache=False):
+    def __init__(self, data, retain_cache=False, cache=None, cipher=None, name=None):
         self.data = data
         self.compressed = None
         self.pos = 0
 
         self.retain_cache = retain_cache
 
+        # When a shared `ChunkCache` is given, it decides how long the
+        # transformed output is kept instead of `retain_cache`.
+        self.cache = cache
+        self.cache_key = cache.new_key() if cache is not None else None
+
+        # Optional `MemberCipher` sealing the transformed output, with the
+        # file's `name` as associated data.
+        self.cipher = cipher
+        self.name = name
+
     def _transform(self, data):
         raise NotImplementedError()
 
+    def _produce(self):
+        result = self._transform(self.data)
+        if self.cipher is not None:
+            result = self.cipher.encrypt(self.name, result)
+        return result
+
     def _compute_cache(self):
         if self.compressed is not None:
             return
 
-        self.compressed = self._transform(self.data)
+        if self.cache is not None:
+            self.compressed = self.cache.get(self.cache_key)
+            if self.compressed is None:
+                self.compressed = self._produce()
+                self.cache.put(self.cache_key, self.compressed)
+        else:
+            self.compressed = self._produce()
 
     def _clear_cache(self):
-        if not self.retain_cache:
+        if self.cache is not None or not self.retain_cache:
             self.compressed = None
 
+    def release(self):
+        """Drops the transformed output, including any copy in the shared
+        cache."""
+        self.compressed = None
+        if self.cache is not None:
+            self.cache.discard(self.cache_key)
+
     def __len__(self):
         self._compute_cache()
         result = len(self.compressed)
@@ -96,6 +140,152 @@ class Lz4Wrapper(TransformWrapper):
         return compressed
 
 
+class SplitWrapper(TransformWrapper):
+    """Transforms a file's content as a split member: fixed-size blocks that
+    are compressed, and encrypted, independently of each other, preceded by
+    a table of their stored sizes.
+
+    Blocks are compressed on `executor` if one is given, so that a single
+    large file can use several cores."""
+
+    def __init__(self, data, flags, block_size, executor=None, **kwargs):
+        super().__init__(data, **kwargs)
+        self.flags = flags
+        self.block_size = block_size
+        self.executor = executor
+
+    def _content_blocks(self, data):
+        if hasattr(data, "read"):
+            data.seek(0)
+            blocks = list(iter(lambda: data.read(self.block_size), b""))
+        else:
+            blocks = [
+                data[start : start + self.block_size]
+                for start in range(0, len(data), self.block_size)
+            ]
+
+        # Even an empty file has a block, so that it can be authenticated.
+        return blocks or [b""]
+
+    def _seal_block(self, item):
+        index, final, block = item
+        if self.flags & FLAG_GZIP != 0:
+            # gzip.compress only takes an mtime from Python 3.8 on.
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as gz:
+                gz.write(block)
+            block = buf.getvalue()
+        elif self.flags & FLAG_LZ4 != 0:
+            block = lz4.frame.compress(
+                block, compression_level=1, store_size=False, content_checksum=True
+            )
+        if self.cipher is not None:
+            block = self.cipher.encrypt_block(self.name, index, final, block)
+        return block
+
+    def _produce(self):
+        # Blocks are sealed one by one as they are transformed.
+        return self._transform(self.data)
+
+    def _transform(self, data):
+        blocks = self._content_blocks(data)
+        items = [
+            (index, index == len(blocks) - 1, block)
+            for index, block in enumerate(blocks)
+        ]
+
+        if self.executor is not None:
+            sealed = list(self.executor.map(self._seal_block, items))
+        else:
+            sealed = [self._seal_block(item) for item in items]
+
+        table = struct.pack("<LL", self.block_size, len(sealed)) + struct.pack(
+            "<{}L".format(len(sealed)), *[len(block) for block in sealed]
+        )
+        return table + b"".join(sealed)
+
+
+class ChunkedWrapper:
+    """Streams a file's content as a chunked member: length-prefixed blocks
+    of the transformed content, ending with `BLOCK_TERMINATOR`.
+
+    The content is read and compressed `BLOCK_SIZE` at a time, so memory use
+    does not depend on the size of the file. When encrypted, every block is
+    sealed on its own with `MemberCipher.encrypt_block`, and a member always
+    has at least one block."""
+
+    def __init__(self, data, flags, cipher=None, name=None):
+        self.data = data
+        self.flags = flags
+        self.cipher = cipher
+        self.name = name
+
+    def _content(self):
+        if hasattr(self.data, "read"):
+            self.data.seek(0)
+            for chunk in iter(lambda: self.data.read(BLOCK_SIZE), b""):
+                yield chunk
+        else:
+            for start in range(0, len(self.data), BLOCK_SIZE):
+                yield self.data[start : start + BLOCK_SIZE]
+
+    def _transformed(self):
+        if self.flags & FLAG_GZIP != 0:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for chunk in self._content():
+                yield compressor.compress(chunk)
+            yield compressor.flush()
+        elif self.flags & FLAG_LZ4 != 0:
+            compressor = lz4.frame.LZ4FrameCompressor(
+                compression_level=1, content_checksum=True
+            )
+            yield compressor.begin()
+            for chunk in self._content():
+                yield compressor.compress(chunk)
+            yield compressor.flush()
+        else:
+            yield from self._content()
+
+    def _blocks(self):
+        """Coalesces the transformed output into blocks of at least
+        `BLOCK_SIZE` bytes, except for the last one."""
+        pending = []
+        pending_len = 0
+        for output in self._transformed():
+            if not output:
+                continue
+            pending.append(output)
+            pending_len += len(output)
+            if pending_len >= BLOCK_SIZE:
+                yield b"".join(pending)
+                pending = []
+                pending_len = 0
+
+        if pending:
+            yield b"".join(pending)
+
+    def frames(self):
+        # Each block is held back until the next one exists, so that the
+        # final block can be marked as such when encrypting.
+        index = 0
+        block = None
+        for next_block in self._blocks():
+            if block is not None:
+                yield from self._frame(index, False, block)
+                index += 1
+            block = next_block
+
+        if block is not None or self.cipher is not None:
+            yield from self._frame(index, True, block or b"")
+        yield BLOCK_TERMINATOR
+
+    def _frame(self, index, final, block):
+        if self.cipher is not None:
+            block = self.cipher.encrypt_block(self.name, index, final, block)
+        yield struct.pack("<L", len(block))
+        yield block
+
+
 class Archiver:
     """
     arc binary format is composed of a header followed by a stream of files.
@@ -110,6 +300,15 @@ class Archiver:
         FLAG_LZ4    0x02        If set, all `content` fields will be lz4 zipped
                                 with compression level 1. `content_len` will be
                                 adjusted accordingly.
+        FLAG_AES_GCM 0x04       If set, all `content` fields will be sealed
+                                with AES-256-GCM after compression, as
+                                `nonce || ciphertext || tag` with the file
+                                name as associated data (see `MemberCipher`).
+        FLAG_CHACHA20 0x08      Same as FLAG_AES_GCM, with ChaCha20-Poly1305.
+        FLAG_CHUNKED 0x10       If set, files use the chunked framing below.
+        FLAG_SPLIT  0x20        If set, `content` fields are split into
+                                blocks, see below. Cannot be combined with
+                                FLAG_CHUNKED.
     3. header_pad,  28          bytes (all 0 bits)
 
     Each file contains the following fields:
@@ -118,9 +317,45 @@ class Archiver:
     2. name,        name_length bytes
     1. content_len, 8           bytes (little endian)
     2. content,     content_len bytes
+
+    With FLAG_CHUNKED, `content_len` and `content` are replaced by a sequence
+    of blocks, which together hold the (compressed) content:
+
+    1. block_len,   4           bytes (little endian, never 0)
+    2. block,       block_len   bytes
+
+    followed by a terminator of 4 zero bytes. When encrypted, every block is
+    sealed on its own, with the file name, the block index and whether it is
+    the last block as associated data (see `MemberCipher.encrypt_block`).
+
+    Chunked archives are produced in a single forward pass with constant
+    memory, and so can only be read forward and have no length up front.
+
+    With FLAG_SPLIT, a file's content is cut into blocks of `block_size`
+    bytes (the last one may be shorter), which are compressed and encrypted
+    independently, so that they can be produced in parallel and any of them
+    decoded on its own. `content` is then:
+
+    1. block_size,  4           bytes (little endian)
+    2. block_count, 4           bytes (little endian, at least 1)
+    3. block_lens,  4 * block_count bytes (little endian stored sizes)
+    4. blocks,      sum(block_lens) bytes
+
+    Encrypted blocks are sealed as with FLAG_CHUNKED.
     """
 
-    def __init__(self, use_gzip=False, use_lz4=False, cache_chunks=False):
+    def __init__(
+        self,
+        use_gzip=False,
+        use_lz4=False,
+        cache_chunks=False,
+        cache=None,
+        cipher=None,
+        chunked=False,
+        block_size=None,
+        block_jobs=1,
+        executor=None,
+    ):
         self.fields = []
         self._add_field(MAGIC)
 
@@ -131,7 +366,29 @@ class Archiver:
         elif use_lz4:
             self.flags |= FLAG_LZ4
 
+        if cipher is not None:
+            self.flags |= cipher.flag
+
+        if chunked:
+            self.flags |= FLAG_CHUNKED
+
+        if block_size is not None:
+            if chunked:
+                raise RuntimeError("Split members cannot be chunked.")
+            self.flags |= FLAG_SPLIT
+
+        self.block_size = block_size
+        # Blocks are compressed on `executor` if given, e.g. a pool shared by
+        # several archives, which is then left running by `release`.
+        self.owns_executor = executor is None
+        if executor is None and block_size is not None and block_jobs > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(block_jobs)
+        self.executor = executor
+
         self.cache_chunks = cache_chunks
+        self.cache = cache
+        self.cipher = cipher
+        self.wrappers = []
 
         self._add_field(struct.pack("<L", self.flags))
         self._add_field(b"\x00" * HEADER_PADDING_LEN)
@@ -139,6 +396,10 @@ class Archiver:
         self.field_idx = 0
         self.field_pos = 0
 
+        # Forward-only output of a chunked archive, created on the first read.
+        self.stream = None
+        self.stream_buffer = b""
+
     def add_file(self, name, content):
         """Adds the given file into the archive.
 
@@ -148,23 +409,87 @@ class Archiver:
         self._add_field(struct.pack("<L", len(name)))
         self._add_field(name.encode())
 
-        if self.flags & FLAG_GZIP != 0:
-            content = GzipWrapper(content, retain_cache=self.cache_chunks)
-        elif self.flags & FLAG_LZ4 != 0:
-            content = Lz4Wrapper(content, retain_cache=self.cache_chunks)
+        if self.flags & FLAG_CHUNKED != 0:
+            self.fields.append(
+                (None, ChunkedWrapper(content, self.flags, self.cipher, name))
+            )
+            return
+
+        kwargs = {
+            "retain_cache": self.cache_chunks,
+            "cache": self.cache,
+            "cipher": self.cipher,
+            "name": name,
+        }
+
+        if self.flags & FLAG_SPLIT != 0:
+            content = SplitWrapper(
+                content, self.flags, self.block_size, self.executor, **kwargs
+            )
         else:
-            content = NoOpWrapper(content, retain_cache=self.cache_chunks)
+            if self.flags & FLAG_GZIP != 0:
+                wrapper_class = GzipWrapper
+            elif self.flags & FLAG_LZ4 != 0:
+                wrapper_class = Lz4Wrapper
+            else:
+                wrapper_class = NoOpWrapper
+
+            content = wrapper_class(content, **kwargs)
+        self.wrappers.append(content)
 
         self._add_field(struct.pack("<Q", _get_length(content)))
         self._add_field(content)
 
+    def release(self):
+        """Frees the compressed output of every file, e.g. once the archive
+        has been uploaded."""
+        for wrapper in self.wrappers:
+            wrapper.release()
+        if self.executor is not None and self.owns_executor:
+            self.executor.shutdown()
+        self.executor = None
+
     def _add_field(self, content):
         self.fields.append((_get_length(content), content))
 
     def __len__(self):
+        if self.flags & FLAG_CHUNKED != 0:
+            raise RuntimeError("Chunked archives have no length up front.")
         return sum(map(lambda f: f[0], self.fields))
 
+    def _stream(self):
+        for _, field_content in self.fields:
+            if isinstance(field_content, ChunkedWrapper):
+                yield from field_content.frames()
+            else:
+                yield bytes(field_content)
+
+    def _read_stream(self, size):
+        if self.stream is None:
+            self.stream = self._stream()
+
+        chunks = [self.stream_buffer]
+        have = len(self.stream_buffer)
+        while have < size:
+            chunk = next(self.stream, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            have += len(chunk)
+
+        data = b"".join(chunks)
+        self.stream_buffer = data[size:]
+        return data[:size]
+
     def read(self, size):
+        if self.flags & FLAG_CHUNKED != 0:
+            return self._read_stream(size)
+
+        # Empty fields (e.g. a zero-length file) would otherwise read as EOF.
+        fields = self.fields
+        while self.field_idx < len(fields) and fields[self.field_idx][0] == 0:
+            self.field_idx += 1
+
         if self.field_idx >= len(self.fields):
             return b""
 
@@ -188,6 +513,11 @@ class Archiver:
         return result
 
     def seek(self, pos):
+        if self.flags & FLAG_CHUNKED != 0:
+            if pos != 0 or self.stream is not None:
+                raise RuntimeError("Chunked archives can only be read forward.")
+            return
+
         self.field_idx = 0
         self.field_pos = pos
 
@@ -0,0 +1,117 @@
+"""Measures Archiver throughput for every codec, with and without encryption.
+
+Run with `python -m arc.benchmark`. Bands are synthesized to be roughly as
+compressible as typical disk images: a mix of random and zero-filled blocks.
+"""
+
+import os
+import time
+import argparse
+
+from arc.archiver import Archiver
+from arc.crypto import CIPHERS, KEY_LEN, MemberCipher
+
+CODECS = {
+    "none": {},
+    "gzip": {"use_gzip": True},
+    "lz4": {"use_lz4": True},
+}
+
+
+def _make_band(size, random_fraction):
+    block = 4096
+    blocks = []
+    for i in range(size // block):
+        if (i * 7919 % 100) < random_fraction * 100:
+            blocks.append(os.urandom(block))
+        else:
+            blocks.append(b"\x00" * block)
+    return b"".join(blocks)
+
+
+def _run(bands, codec, cipher, block_size, block_jobs):
+    start = time.perf_counter()
+
+    # Chunks are cached so that every member is transformed exactly once.
+    arc = Archiver(
+        cache_chunks=True,
+        cipher=cipher,
+        block_size=block_size,
+        block_jobs=block_jobs,
+        **CODECS[codec]
+    )
+    for i, band in enumerate(bands):
+        arc.add_file(format(i, "x"), band)
+    for _ in iter(lambda: arc.read(1024 * 1024), b""):
+        pass
+    arc.release()
+
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--bands", type=int, default=16, help="Number of bands per archive."
+    )
+    parser.add_argument(
+        "--band-size", type=int, default=8, help="Size of each band in MiB."
+    )
+    parser.add_argument(
+        "--random-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of incompressible blocks in each band.",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="Split bands into independently compressed blocks of this many KiB.",
+    )
+    parser.add_argument(
+        "--block-jobs",
+        type=int,
+        default=1,
+        help="Number of threads compressing blocks with --block-size.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Keep the best of this many runs."
+    )
+    args = parser.parse_args()
+
+    bands = [
+        _make_band(args.band_size * 1024 * 1024, args.random_fraction)
+        for _ in range(args.bands)
+    ]
+    total = args.bands * args.band_size * 1024 * 1024
+    key = os.urandom(KEY_LEN)
+    block_size = args.block_size * 1024 if args.block_size is not None else None
+    run_args = (block_size, args.block_jobs)
+
+    print("{:6} {:10} {:>10} {:>10}".format("codec", "cipher", "MB/s", "overhead"))
+    for codec in CODECS:
+        baseline = min(_run(bands, codec, None, *run_args) for _ in range(args.repeat))
+        print(
+            "{:6} {:10} {:>10.1f} {:>10}".format(
+                codec, "-", total / baseline / 1000 / 1000, "-"
+            )
+        )
+
+        for name, flag in sorted(CIPHERS.items()):
+            cipher = MemberCipher(flag, key)
+            elapsed = min(
+                _run(bands, codec, cipher, *run_args) for _ in range(args.repeat)
+            )
+            print(
+                "{:6} {:10} {:>10.1f} {:>9.1f}%".format(
+                    codec,
+                    name,
+                    total / elapsed / 1000 / 1000,
+                    (elapsed / baseline - 1) * 100,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import collections
+import itertools
+import os
+import threading
+
+
+class ChunkCache:
+    """Byte-budgeted LRU cache of compressed member outputs.
+
+    One cache is meant to be shared by every `Archiver` in the process, so
+    that the memory held by compressed members never exceeds `budget` bytes
+    no matter how many or how large the packages are. Entries evicted from
+    memory are written to `spill_dir` if one is given, and read back on the
+    next access; otherwise they are dropped and recompressed when needed.
+
+    Keys are allocated with `new_key()`."""
+
+    def __init__(self, budget, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.spilled = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def new_key(self):
+        return next(self._keys)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, "chunk-{}-{}".format(os.getpid(), key))
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            if key not in self.spilled:
+                self.misses += 1
+                return None
+
+            self.spilled.remove(key)
+            path = self._spill_path(key)
+            with open(path, "rb") as file:
+                data = file.read()
+            os.remove(path)
+
+            self.hits += 1
+            self._insert(key, data)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._discard(key)
+            self._insert(key, data)
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        elif key in self.spilled:
+            self.spilled.remove(key)
+            os.remove(self._spill_path(key))
+
+    def _insert(self, key, data):
+        self.entries[key] = data
+        self.size += len(data)
+
+        while self.size > self.budget:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+            if self.spill_dir is not None:
+                with open(self._spill_path(evicted_key), "wb") as file:
+                    file.write(evicted)
+                self.spilled.add(evicted_key)
+                self.spills += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "spills": self.spills,
+                "size": self.size,
+            }
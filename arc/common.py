@@ -4,5 +4,11 @@ HEADER_LEN = 32
 
 FLAG_GZIP = 0x01
 FLAG_LZ4 = 0x02
+FLAG_AES_GCM = 0x04
+FLAG_CHACHA20 = 0x08
+FLAG_CHUNKED = 0x10
+FLAG_SPLIT = 0x20
+
+FLAGS_ENCRYPTED = FLAG_AES_GCM | FLAG_CHACHA20
 
 HEADER_PADDING_LEN = 28
@@ -0,0 +1,154 @@
+import os
+import hmac
+import hashlib
+import binascii
+
+from .common import FLAG_AES_GCM, FLAG_CHACHA20, FLAGS_ENCRYPTED
+
+KEY_LEN = 32
+NONCE_LEN = 12
+TAG_LEN = 16
+
+# Environment variable holding a hex-encoded key, used when no key file is
+# given.
+KEY_ENV = "ARC_KEY"
+
+CIPHERS = {"aes-gcm": FLAG_AES_GCM, "chacha20": FLAG_CHACHA20}
+
+# HKDF labels of the subkeys derived from a key, so that no key is used for
+# more than one purpose.
+ENCRYPTION_INFO = b"arc encryption key"
+NONCE_INFO = b"arc nonce key"
+KEY_ID_INFO = b"arc key id"
+
+
+def _parse_key(raw):
+    stripped = raw.strip()
+    if len(stripped) == 2 * KEY_LEN:
+        try:
+            return binascii.unhexlify(stripped)
+        except binascii.Error:
+            pass
+
+    if len(raw) == KEY_LEN:
+        return raw
+
+    raise RuntimeError(
+        "Encryption key must be {} raw bytes or {} hex digits.".format(
+            KEY_LEN, 2 * KEY_LEN
+        )
+    )
+
+
+def load_key(path=None):
+    """Loads a key from the file at `path`, or from the `ARC_KEY` environment
+    variable if `path` is None. Returns None if neither is available."""
+    if path is not None:
+        with open(path, "rb") as file:
+            return _parse_key(file.read())
+
+    if os.environ.get(KEY_ENV):
+        return _parse_key(os.environ[KEY_ENV].encode())
+
+    return None
+
+
+class MemberCipher:
+    """Authenticated encryption of individual archive members.
+
+    Each member is sealed on its own as `nonce || ciphertext || tag`, with
+    the member name as associated data. The nonce is derived from the name
+    and the plaintext with HMAC-SHA256, so that encrypting the same member
+    twice yields the same bytes: archives stay reproducible, and a nonce is
+    only ever reused for an identical message. The AEAD and the HMAC use
+    separate subkeys, derived from the key with HKDF-SHA256."""
+
+    def __init__(self, flag, key):
+        try:
+            from cryptography.hazmat.primitives.ciphers.aead import (
+                AESGCM,
+                ChaCha20Poly1305,
+            )
+            from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.exceptions import InvalidTag
+        except ImportError:
+            raise RuntimeError("Encryption requires the `cryptography` package.")
+
+        def derive(info):
+            return HKDF(
+                algorithm=hashes.SHA256(),
+                length=KEY_LEN,
+                salt=None,
+                info=info,
+                backend=default_backend(),
+            ).derive(key)
+
+        if flag == FLAG_AES_GCM:
+            self.aead = AESGCM(derive(ENCRYPTION_INFO))
+        elif flag == FLAG_CHACHA20:
+            self.aead = ChaCha20Poly1305(derive(ENCRYPTION_INFO))
+        else:
+            raise RuntimeError("Unknown cipher flag: {:#x}".format(flag))
+
+        self.flag = flag
+        self.nonce_key = derive(NONCE_INFO)
+        # Identifies the key without revealing it, e.g. to tell whether
+        # something was encrypted with the same key.
+        self.key_id = derive(KEY_ID_INFO)[:16].hex()
+        self.invalid_tag = InvalidTag
+
+    @classmethod
+    def for_flags(cls, flags, key):
+        """Returns the cipher an archive with `flags` was encrypted with, or
+        None if it is not encrypted."""
+        if flags & FLAGS_ENCRYPTED == 0:
+            return None
+        if key is None:
+            raise RuntimeError("Archive is encrypted but no key was given.")
+        return cls(flags & FLAGS_ENCRYPTED, key)
+
+    def _nonce(self, associated, data):
+        mac = hmac.new(self.nonce_key, digestmod=hashlib.sha256)
+        mac.update(len(associated).to_bytes(4, "little"))
+        mac.update(associated)
+        mac.update(data)
+        return mac.digest()[:NONCE_LEN]
+
+    def _seal(self, associated, data):
+        nonce = self._nonce(associated, data)
+        return nonce + self.aead.encrypt(nonce, bytes(data), associated)
+
+    def _open(self, associated, data, name):
+        if len(data) < NONCE_LEN + TAG_LEN:
+            raise RuntimeError("Encrypted content of {} is truncated.".format(name))
+
+        try:
+            return self.aead.decrypt(
+                bytes(data[:NONCE_LEN]), bytes(data[NONCE_LEN:]), associated
+            )
+        except self.invalid_tag:
+            raise RuntimeError(
+                "Failed to authenticate {} -- wrong key or corrupted "
+                "archive.".format(name)
+            )
+
+    @staticmethod
+    def _block_associated(name, index, final):
+        return name.encode() + index.to_bytes(8, "little") + bytes([final])
+
+    def encrypt(self, name, data):
+        return self._seal(name.encode(), data)
+
+    def decrypt(self, name, data):
+        return self._open(name.encode(), data, name)
+
+    def encrypt_block(self, name, index, final, data):
+        """Seals block `index` of a chunked member. The block's position and
+        whether it is the `final` one are authenticated along with the name,
+        so blocks cannot be reordered, dropped or truncated away."""
+        return self._seal(self._block_associated(name, index, final), data)
+
+    def decrypt_block(self, name, index, final, data):
+        return self._open(self._block_associated(name, index, final), data, name)
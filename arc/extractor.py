@@ -0,0 +1,124 @@
+import os
+import mmap
+import functools
+import multiprocessing
+
+from .crypto import MemberCipher
+from .unarchiver import Unarchiver, _decode, _is_transformed
+
+# Per-process state of extraction workers, set up by `_init_worker`.
+_worker = {}
+
+
+def _init_worker(path, outdir, key):
+    fd = os.open(path, os.O_RDONLY)
+    size = os.fstat(fd).st_size
+
+    _worker["fd"] = fd
+    _worker["map"] = mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else b""
+    _worker["outdir"] = outdir
+    _worker["key"] = key
+    _worker["ciphers"] = {}
+
+
+def _close_worker():
+    if isinstance(_worker["map"], mmap.mmap):
+        _worker["map"].close()
+    os.close(_worker["fd"])
+    _worker.clear()
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                count = os.copy_file_range(
+                    src_fd, dst_fd, length - copied, offset + copied, copied
+                )
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+
+    if copied < length:
+        _pwrite_all(dst_fd, _worker["map"][offset + copied : offset + length], copied)
+
+
+def _extract_member(member):
+    name, offset, length, flags = member
+    full_path = os.path.join(_worker["outdir"], name)
+
+    fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if _is_transformed(flags):
+            if flags not in _worker["ciphers"]:
+                _worker["ciphers"][flags] = MemberCipher.for_flags(
+                    flags, _worker["key"]
+                )
+            data = _decode(
+                _worker["map"][offset : offset + length],
+                flags,
+                name,
+                _worker["ciphers"][flags],
+            )
+            _pwrite_all(fd, data, 0)
+            size = len(data)
+        else:
+            _copy_range(_worker["fd"], fd, offset, length)
+            size = length
+    finally:
+        os.close(fd)
+
+    return full_path, size
+
+
+def extract(path, outdir, jobs=1, key=None):
+    """Extracts every file of the archive at `path` into `outdir`.
+
+    The archive is mmapped and its members are decompressed and written
+    independently by `jobs` worker processes. Yields `(full_path, size)`
+    for each extracted file as it completes."""
+    with open(path, "rb") as arc_file:
+        members = Unarchiver(arc_file).members()
+
+    if jobs <= 1:
+        _init_worker(path, outdir, key)
+        try:
+            for member in members:
+                yield _extract_member(member)
+        finally:
+            _close_worker()
+        return
+
+    with multiprocessing.Pool(
+        jobs, initializer=_init_worker, initargs=(path, outdir, key)
+    ) as pool:
+        for result in pool.imap_unordered(_extract_member, members):
+            yield result
+
+
+def extract_stream(file, outdir, key=None):
+    """Extracts every file of an archive read strictly forward from `file`
+    into `outdir`, overlapping decompression with reading the stream.
+    Yields `(full_path, size)` for each extracted file."""
+    for name, content in Unarchiver(file, key).stream():
+        full_path = os.path.join(outdir, name)
+        size = 0
+
+        with open(full_path, "wb") as out_file:
+            for chunk in iter(functools.partial(content.read, 1024 * 1024), b""):
+                out_file.write(chunk)
+                size += len(chunk)
+
+        yield full_path, size
@@ -82,6 +82,27 @@ class TestArchiver(unittest.TestCase):
         self.assertEqual(len(arc), len(expected))
         self.assertEqual(read_all(arc), expected)
 
+    def test_empty_file_followed_by_file(self):
+        arc = Archiver()
+
+        arc.add_file("test", b"")
+        arc.add_file("wow", b"suchgreatstuff")
+
+        expected = (
+            b"arcf"
+            + b"\x00" * 32
+            + b"\x04\x00\x00\x00"
+            + b"test"
+            + b"\x00\x00\x00\x00\x00\x00\x00\x00"
+            + b"\x03\x00\x00\x00"
+            + b"wow"
+            + b"\x0e\x00\x00\x00\x00\x00\x00\x00"
+            + b"suchgreatstuff"
+        )
+
+        self.assertEqual(len(arc), len(expected))
+        self.assertEqual(read_all(arc), expected)
+
     def test_add_one_file_object(self):
         with tempfile.NamedTemporaryFile() as tf:
             tf.write(b"testcontent")
@@ -391,6 +412,74 @@ class TestArchiver(unittest.TestCase):
         self.assertEqual(len(arc), len(expected))
         self.assertEqual(read_all(arc), expected)
 
+    def test_chunked(self):
+        arc = Archiver(chunked=True)
+        arc.add_file("test", b"testcontent")
+        arc.add_file("empty", b"")
+
+        expected = (
+            b"arcf"
+            + b"\x10\x00\x00\x00"
+            + b"\x00" * 28
+            + b"\x04\x00\x00\x00"
+            + b"test"
+            + b"\x0b\x00\x00\x00"
+            + b"testcontent"
+            + b"\x00\x00\x00\x00"
+            + b"\x05\x00\x00\x00"
+            + b"empty"
+            + b"\x00\x00\x00\x00"
+        )
+
+        self.assertEqual(read_all(arc, 3), expected)
+
+    def test_chunked_forward_only(self):
+        arc = Archiver(chunked=True, use_lz4=True)
+        arc.add_file("test", UnseekableFile(b"testcontent"))
+
+        with self.assertRaises(RuntimeError):
+            len(arc)
+
+        arc.seek(0)
+        arc.read(10)
+        with self.assertRaises(RuntimeError):
+            arc.seek(0)
+
+    def test_split(self):
+        arc = Archiver(block_size=4)
+        arc.add_file("test", b"testcontent")
+
+        expected = (
+            b"arcf"
+            + b"\x20\x00\x00\x00"
+            + b"\x00" * 28
+            + b"\x04\x00\x00\x00"
+            + b"test"
+            + b"\x1f\x00\x00\x00\x00\x00\x00\x00"
+            + b"\x04\x00\x00\x00"
+            + b"\x03\x00\x00\x00"
+            + b"\x04\x00\x00\x00\x04\x00\x00\x00\x03\x00\x00\x00"
+            + b"testcontent"
+        )
+
+        self.assertEqual(len(arc), len(expected))
+        self.assertEqual(read_all(arc), expected)
+
+    def test_split_parallel_matches_serial(self):
+        content = b"".join(bytes([i]) * 1000 for i in range(100))
+
+        serial = Archiver(use_gzip=True, block_size=4096)
+        serial.add_file("test", content)
+        parallel = Archiver(use_gzip=True, block_size=4096, block_jobs=4)
+        parallel.add_file("test", content)
+
+        self.assertEqual(read_all(parallel), read_all(serial))
+        parallel.release()
+
+    def test_split_cannot_be_chunked(self):
+        with self.assertRaises(RuntimeError):
+            Archiver(chunked=True, block_size=4096)
+
 
 if __name__ == "__main__":
     unittest.main()
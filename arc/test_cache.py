@@ -0,0 +1,98 @@
+import unittest
+import os
+import tempfile
+
+from arc.archiver import Archiver
+from arc.cache import ChunkCache
+from arc.test_archiver import UnseekableFile, read_all
+
+
+class TestChunkCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = ChunkCache(100)
+        key = cache.new_key()
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b"testcontent")
+        self.assertEqual(cache.get(key), b"testcontent")
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 11)
+
+    def test_lru_eviction(self):
+        cache = ChunkCache(24)
+        first, second, third = cache.new_key(), cache.new_key(), cache.new_key()
+
+        cache.put(first, b"testcontent")
+        cache.put(second, b"suchgreat")
+        cache.get(first)
+        cache.put(third, b"stuff")
+
+        self.assertEqual(cache.get(first), b"testcontent")
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(cache.get(third), b"stuff")
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertLessEqual(cache.stats()["size"], 24)
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            cache = ChunkCache(15, tempdir)
+            first, second = cache.new_key(), cache.new_key()
+
+            cache.put(first, b"testcontent")
+            cache.put(second, b"suchgreatstuff")
+            self.assertEqual(len(os.listdir(tempdir)), 1)
+
+            self.assertEqual(cache.get(first), b"testcontent")
+            self.assertEqual(cache.get(second), b"suchgreatstuff")
+            self.assertEqual(cache.stats()["spills"], 3)
+            self.assertEqual(cache.stats()["hits"], 2)
+
+            cache.discard(first)
+            cache.discard(second)
+            self.assertEqual(os.listdir(tempdir), [])
+            self.assertEqual(cache.stats()["size"], 0)
+
+    def test_archiver_one_pass_only(self):
+        cache = ChunkCache(1024)
+        arc = Archiver(use_gzip=True, cache=cache)
+
+        arc.add_file("test", UnseekableFile(b"testcontent"))
+
+        expected = (
+            b"arcf"
+            + b"\x01\x00\x00\x00"
+            + b"\x00" * 28
+            + b"\x04\x00\x00\x00"
+            + b"test"
+            + b"\x1f\x00\x00\x00\x00\x00\x00\x00"
+            + b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff\x2b\x49\x2d\x2e\x49\xce"
+            + b"\xcf\x2b\x49\xcd\x2b\x01\x00\x04\xd0\x2f\x90\x0b\x00\x00\x00"
+        )
+
+        self.assertEqual(len(arc), len(expected))
+        self.assertEqual(read_all(arc), expected)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        arc.release()
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_archiver_over_budget(self):
+        cache = ChunkCache(16)
+        arc = Archiver(use_lz4=True, cache=cache)
+        arc.add_file("test", b"0" * 100000)
+        arc.add_file("wow", b"1" * 100000)
+
+        expected = Archiver(use_lz4=True)
+        expected.add_file("test", b"0" * 100000)
+        expected.add_file("wow", b"1" * 100000)
+
+        self.assertEqual(len(arc), len(expected))
+        self.assertEqual(read_all(arc), read_all(expected))
+        self.assertLessEqual(cache.stats()["size"], 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import io
+import os
+import tempfile
+
+from arc.archiver import BLOCK_SIZE, Archiver
+from arc.common import MAGIC, FLAG_AES_GCM, FLAG_CHACHA20, HEADER_LEN
+from arc.crypto import MemberCipher, load_key, KEY_ENV
+from arc.extractor import extract
+from arc.unarchiver import Unarchiver
+from arc.test_unarchiver import ShortReadStream, read_all
+
+KEY = bytes(range(32))
+OTHER_KEY = bytes(range(1, 33))
+
+CONTENTS = [("test", b"testcontent"), ("empty", b""), ("wow", b"suchgreatstuff" * 1000)]
+
+
+def build(flag, key=KEY, **kwargs):
+    arc = Archiver(cipher=MemberCipher(flag, key), **kwargs)
+    for name, content in CONTENTS:
+        arc.add_file(name, content)
+    return read_all(arc)
+
+
+class TestCrypto(unittest.TestCase):
+    def _check_roundtrip(self, flag, **kwargs):
+        content = build(flag, **kwargs)
+
+        self.assertNotIn(b"testcontent", content)
+        self.assertEqual(content, build(flag, **kwargs))
+
+        files = Unarchiver(io.BytesIO(content), KEY).files()
+        self.assertEqual([(n, read_all(f)) for n, f in files], CONTENTS)
+
+        streamed = Unarchiver(ShortReadStream(content), KEY).stream()
+        self.assertEqual([(n, read_all(f)) for n, f in streamed], CONTENTS)
+
+    def test_aes_gcm(self):
+        self._check_roundtrip(FLAG_AES_GCM)
+
+    def test_aes_gcm_gzip(self):
+        self._check_roundtrip(FLAG_AES_GCM, use_gzip=True)
+
+    def test_chacha20_lz4(self):
+        self._check_roundtrip(FLAG_CHACHA20, use_lz4=True)
+
+    def test_aes_gcm_chunked(self):
+        self._check_roundtrip(FLAG_AES_GCM, chunked=True)
+
+    def test_chacha20_chunked_gzip(self):
+        self._check_roundtrip(FLAG_CHACHA20, use_gzip=True, chunked=True)
+
+    def test_subkeys(self):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        cipher = MemberCipher(FLAG_AES_GCM, KEY)
+        sealed = cipher.encrypt("test", b"testcontent")
+
+        # Neither the AEAD nor the nonce derivation use the key itself.
+        with self.assertRaises(InvalidTag):
+            AESGCM(KEY).decrypt(sealed[:12], sealed[12:], b"test")
+        self.assertNotEqual(cipher.nonce_key, KEY)
+
+    def test_chunked_dropped_block(self):
+        cipher = MemberCipher(FLAG_AES_GCM, KEY)
+        arc = Archiver(cipher=cipher, chunked=True)
+        arc.add_file("long", os.urandom(3 * BLOCK_SIZE))
+        content = read_all(arc)
+
+        # Cuts the member after its first block, as if it were complete.
+        start = len(MAGIC) + HEADER_LEN + 4 + len("long")
+        first_len = int.from_bytes(content[start : start + 4], "little")
+        truncated = content[: start + 4 + first_len] + b"\x00" * 4
+
+        files = Unarchiver(io.BytesIO(truncated), KEY).files()
+        with self.assertRaises(RuntimeError):
+            read_all(files[0][1])
+
+    def test_aes_gcm_split(self):
+        self._check_roundtrip(FLAG_AES_GCM, use_lz4=True, block_size=1000)
+
+    def test_split_dropped_block(self):
+        cipher = MemberCipher(FLAG_CHACHA20, KEY)
+        arc = Archiver(cipher=cipher, block_size=1000)
+        arc.add_file("long", os.urandom(3000))
+        content = read_all(arc)
+
+        # Drops the last block and its entry in the block table.
+        start = len(MAGIC) + HEADER_LEN + 4 + len("long")
+        content_len = int.from_bytes(content[start : start + 8], "little")
+        last_len = int.from_bytes(content[start + 24 : start + 28], "little")
+        truncated = (
+            content[:start]
+            + (content_len - 4 - last_len).to_bytes(8, "little")
+            + content[start + 8 : start + 12]
+            + (2).to_bytes(4, "little")
+            + content[start + 16 : start + 24]
+            + content[start + 28 : -last_len]
+        )
+
+        files = Unarchiver(io.BytesIO(truncated), KEY).files()
+        with self.assertRaisesRegex(RuntimeError, "authenticate"):
+            read_all(files[0][1])
+
+    def test_wrong_key(self):
+        content = build(FLAG_AES_GCM, use_lz4=True)
+
+        files = Unarchiver(io.BytesIO(content), OTHER_KEY).files()
+        with self.assertRaises(RuntimeError):
+            read_all(files[0][1])
+
+    def test_missing_key(self):
+        content = build(FLAG_CHACHA20)
+
+        with self.assertRaises(RuntimeError):
+            Unarchiver(io.BytesIO(content)).files()
+
+    def test_swapped_members(self):
+        cipher = MemberCipher(FLAG_AES_GCM, KEY)
+        sealed = cipher.encrypt("test", b"testcontent")
+
+        with self.assertRaises(RuntimeError):
+            cipher.decrypt("wow", sealed)
+
+    def test_extract_parallel(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            arc_path = os.path.join(tempdir, "test.arc")
+            with open(arc_path, "wb") as file:
+                file.write(build(FLAG_AES_GCM, use_gzip=True))
+
+            results = sorted(extract(arc_path, tempdir, 2, KEY))
+            self.assertEqual(len(results), len(CONTENTS))
+
+            for name, content in CONTENTS:
+                with open(os.path.join(tempdir, name), "rb") as file:
+                    self.assertEqual(file.read(), content)
+
+    def test_load_key(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            raw_path = os.path.join(tempdir, "raw")
+            with open(raw_path, "wb") as file:
+                file.write(KEY)
+            self.assertEqual(load_key(raw_path), KEY)
+
+            hex_path = os.path.join(tempdir, "hex")
+            with open(hex_path, "wb") as file:
+                file.write(KEY.hex().encode() + b"\n")
+            self.assertEqual(load_key(hex_path), KEY)
+
+            short_path = os.path.join(tempdir, "short")
+            with open(short_path, "wb") as file:
+                file.write(b"tooshort")
+            with self.assertRaises(RuntimeError):
+                load_key(short_path)
+
+        old = os.environ.pop(KEY_ENV, None)
+        try:
+            self.assertIsNone(load_key())
+            os.environ[KEY_ENV] = OTHER_KEY.hex()
+            self.assertEqual(load_key(), OTHER_KEY)
+        finally:
+            os.environ.pop(KEY_ENV, None)
+            if old is not None:
+                os.environ[KEY_ENV] = old
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+
+from arc.archiver import Archiver
+from arc.extractor import extract
+
+
+class TestExtractor(unittest.TestCase):
+    def _check_extract(self, jobs, **kwargs):
+        contents = {
+            "test": b"testcontent",
+            "wow": b"suchgreatstuff" * 10000,
+            "empty": b"",
+        }
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            arc = Archiver(**kwargs)
+            for name in sorted(contents):
+                arc.add_file(name, contents[name])
+
+            arc_path = os.path.join(tempdir, "test.arc")
+            with open(arc_path, "wb") as file:
+                for chunk in iter(lambda: arc.read(8192), b""):
+                    file.write(chunk)
+
+            outdir = os.path.join(tempdir, "out")
+            os.mkdir(outdir)
+
+            results = sorted(extract(arc_path, outdir, jobs))
+            self.assertEqual(
+                results,
+                sorted(
+                    (os.path.join(outdir, name), len(content))
+                    for name, content in contents.items()
+                ),
+            )
+
+            for name, content in contents.items():
+                with open(os.path.join(outdir, name), "rb") as file:
+                    self.assertEqual(file.read(), content)
+
+    def test_stored(self):
+        self._check_extract(1)
+
+    def test_stored_parallel(self):
+        self._check_extract(2)
+
+    def test_gzip_parallel(self):
+        self._check_extract(2, use_gzip=True)
+
+    def test_lz4_parallel(self):
+        self._check_extract(2, use_lz4=True)
+
+    def test_chunked_parallel(self):
+        self._check_extract(2, use_lz4=True, chunked=True)
+
+    def test_split_parallel(self):
+        self._check_extract(2, use_gzip=True, block_size=4096)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,37 @@
 import unittest
 import io
+import os
 
 from arc.unarchiver import Unarchiver
-from arc.archiver import Archiver
+from arc.archiver import BLOCK_SIZE, Archiver
+
+
+class ShortReadStream:
+    """Forward-only stream returning at most 3 bytes per read, like a
+    network body might."""
+
+    def __init__(self, content):
+        self.content = content
+        self.pos = 0
+
+    def read(self, size):
+        to_read = min(size, 3, len(self.content) - self.pos)
+        result = self.content[self.pos : self.pos + to_read]
+        self.pos += to_read
+        return result
+
+
+class CountingStream(io.BytesIO):
+    """BytesIO that counts the bytes read from it."""
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.count = 0
+
+    def read(self, size=-1):
+        result = super().read(size)
+        self.count += len(result)
+        return result
 
 
 # TODO: DRY
@@ -108,6 +137,147 @@ class TestUnarchiver(unittest.TestCase):
         self.assertEqual(files[0][0], "test")
         self.assertEqual(read_all(files[0][1]), b"0" * 100000)
 
+    def _check_stream(self, read_members=True, **kwargs):
+        arc = Archiver(**kwargs)
+        arc.add_file("test", b"testcontent")
+        arc.add_file("empty", b"")
+        arc.add_file("wow", b"suchgreatstuff" * 1000)
+
+        unarc = Unarchiver(ShortReadStream(read_all(arc)))
+
+        names = []
+        for name, file in unarc.stream():
+            names.append(name)
+            if name == "test" or read_members:
+                expected = {
+                    "test": b"testcontent",
+                    "empty": b"",
+                    "wow": b"suchgreatstuff" * 1000,
+                }[name]
+                self.assertEqual(read_all(file, 1000000), expected)
+
+        self.assertEqual(names, ["test", "empty", "wow"])
+
+    def test_stream(self):
+        self._check_stream()
+
+    def test_stream_gzip(self):
+        self._check_stream(use_gzip=True)
+
+    def test_stream_lz4(self):
+        self._check_stream(use_lz4=True)
+
+    def test_stream_skip_unread(self):
+        self._check_stream(read_members=False, use_gzip=True)
+
+    def test_stream_chunked(self):
+        self._check_stream(chunked=True)
+
+    def test_stream_chunked_lz4(self):
+        self._check_stream(chunked=True, use_lz4=True)
+
+    def test_stream_chunked_skip_unread(self):
+        self._check_stream(read_members=False, chunked=True, use_gzip=True)
+
+    def test_chunked_multiple_blocks(self):
+        long_content = os.urandom(2 * BLOCK_SIZE + 5)
+
+        for kwargs in [{}, {"use_gzip": True}, {"use_lz4": True}]:
+            arc = Archiver(chunked=True, **kwargs)
+            arc.add_file("long", long_content)
+            arc.add_file("test", b"testcontent")
+            content = read_all(arc)
+
+            files = Unarchiver(io.BytesIO(content)).files()
+            self.assertEqual(
+                [(n, read_all(f)) for n, f in files],
+                [("long", long_content), ("test", b"testcontent")],
+            )
+
+            streamed = Unarchiver(ShortReadStream(content)).stream()
+            self.assertEqual(
+                [(n, read_all(f, 100000)) for n, f in streamed],
+                [("long", long_content), ("test", b"testcontent")],
+            )
+
+    def test_stream_chunked_truncated(self):
+        arc = Archiver(chunked=True)
+        arc.add_file("test", b"testcontent")
+
+        unarc = Unarchiver(io.BytesIO(read_all(arc)[:-2]))
+
+        with self.assertRaises(RuntimeError):
+            for _, file in unarc.stream():
+                read_all(file)
+
+    def test_split(self):
+        long_content = os.urandom(5000) + b"0" * 5000
+
+        for kwargs in [{}, {"use_gzip": True}, {"use_lz4": True}]:
+            arc = Archiver(block_size=1024, block_jobs=2, **kwargs)
+            arc.add_file("long", long_content)
+            arc.add_file("empty", b"")
+            content = read_all(arc)
+
+            files = Unarchiver(io.BytesIO(content)).files()
+            self.assertEqual(
+                [(n, read_all(f, 1500)) for n, f in files],
+                [("long", long_content), ("empty", b"")],
+            )
+
+            streamed = Unarchiver(ShortReadStream(content)).stream()
+            self.assertEqual(
+                [(n, read_all(f, 700)) for n, f in streamed],
+                [("long", long_content), ("empty", b"")],
+            )
+
+    def test_split_seek(self):
+        long_content = os.urandom(100 * 1024)
+
+        arc = Archiver(use_lz4=True, block_size=4096)
+        arc.add_file("long", long_content)
+        file = CountingStream(read_all(arc))
+
+        _, wrapper = Unarchiver(file).files()[0]
+        file.count = 0
+
+        wrapper.seek(50000)
+        self.assertEqual(wrapper.read(5000), long_content[50000:55000])
+        wrapper.seek(len(long_content) - 10)
+        self.assertEqual(wrapper.read(100), long_content[-10:])
+        self.assertEqual(wrapper.read(100), b"")
+
+        # Only the table and the three blocks touched are read.
+        self.assertLess(file.count, 5 * 4096)
+
+    def test_read_at_end_does_not_decode_again(self):
+        long_content = os.urandom(100 * 1024)
+
+        arc = Archiver(use_gzip=True)
+        arc.add_file("long", long_content)
+        file = CountingStream(read_all(arc))
+
+        _, wrapper = Unarchiver(file).files()[0]
+        file.count = 0
+
+        self.assertEqual(read_all(wrapper), long_content)
+        self.assertEqual(wrapper.read(100), b"")
+        self.assertLess(file.count, 2 * len(long_content))
+
+        # Seeking back still decodes the content again.
+        wrapper.seek(10)
+        self.assertEqual(wrapper.read(10), long_content[10:20])
+
+    def test_stream_truncated(self):
+        arc = Archiver(use_gzip=True)
+        arc.add_file("test", b"testcontent")
+
+        unarc = Unarchiver(io.BytesIO(read_all(arc)[:-5]))
+
+        with self.assertRaises(RuntimeError):
+            for _, file in unarc.stream():
+                read_all(file)
+
 
 if __name__ == "__main__":
     unittest.main()
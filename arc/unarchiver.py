@@ -1,42 +1,221 @@
 import struct
 import gzip
+import zlib
+import io
 
 import lz4.frame
 
 from .common import *
+from .crypto import MemberCipher
+
+
+def _is_transformed(flags):
+    return (
+        flags & (FLAG_GZIP | FLAG_LZ4 | FLAGS_ENCRYPTED | FLAG_CHUNKED | FLAG_SPLIT)
+        != 0
+    )
+
+
+def _decompress(compressed, flags):
+    if flags & FLAG_GZIP != 0:
+        return gzip.decompress(compressed)
+    elif flags & FLAG_LZ4 != 0:
+        return lz4.frame.decompress(compressed)
+    else:
+        assert False
+
+
+def _read_block_len(file):
+    block_len_bytes = _read_exactly(file, 4)
+    if len(block_len_bytes) != 4:
+        raise RuntimeError("Unexpected end of archive.")
+    return struct.unpack("<L", block_len_bytes)[0]
+
+
+def _blocks(file, name, cipher):
+    """Yields the payload of every block of a chunked member read from `file`,
+    up to and including its terminator."""
+    index = 0
+    block_len = _read_block_len(file)
+
+    if block_len == 0 and cipher is not None:
+        raise RuntimeError("Encrypted content of {} is truncated.".format(name))
+
+    while block_len != 0:
+        block = _read_exactly(file, block_len)
+        if len(block) != block_len:
+            raise RuntimeError("Unexpected end of archive.")
+
+        # The next length is needed to know whether this block is the last.
+        block_len = _read_block_len(file)
+        if cipher is not None:
+            block = cipher.decrypt_block(name, index, block_len == 0, block)
+
+        yield block
+        index += 1
+
+
+def _read_split_table(file, length, name):
+    """Reads the block table at the start of a split member's `length` bytes
+    of stored content. Returns `(block_size, block_lens)`."""
+    header = _read_exactly(file, 8)
+    if len(header) != 8:
+        raise RuntimeError("Unexpected end of archive.")
+
+    block_size, block_count = struct.unpack("<LL", header)
+    if block_size == 0 or block_count == 0 or 8 + 4 * block_count > length:
+        raise RuntimeError("Invalid block table of {}.".format(name))
+
+    block_lens_bytes = _read_exactly(file, 4 * block_count)
+    if len(block_lens_bytes) != 4 * block_count:
+        raise RuntimeError("Unexpected end of archive.")
+
+    block_lens = struct.unpack("<{}L".format(block_count), block_lens_bytes)
+    if 8 + 4 * block_count + sum(block_lens) != length:
+        raise RuntimeError("Invalid block table of {}.".format(name))
+
+    return block_size, block_lens
+
+
+def _decode_split_block(raw, flags, name, cipher, index, final, block_size):
+    if cipher is not None:
+        raw = cipher.decrypt_block(name, index, final, raw)
+    if flags & (FLAG_GZIP | FLAG_LZ4) != 0:
+        raw = _decompress(raw, flags)
+
+    # Every block but the last is full; this also catches a forged block size.
+    if len(raw) > block_size or (not final and len(raw) != block_size):
+        raise RuntimeError("Invalid block {} of {}.".format(index, name))
+    return raw
+
+
+def _decode(content, flags, name, cipher):
+    """Undoes the framing, encryption and compression of a whole stored
+    content."""
+    if flags & FLAG_SPLIT != 0:
+        stream = io.BytesIO(content)
+        block_size, block_lens = _read_split_table(stream, len(content), name)
+        return b"".join(
+            _decode_split_block(
+                stream.read(block_len),
+                flags,
+                name,
+                cipher,
+                index,
+                index == len(block_lens) - 1,
+                block_size,
+            )
+            for index, block_len in enumerate(block_lens)
+        )
+
+    if flags & FLAG_CHUNKED != 0:
+        content = b"".join(_blocks(io.BytesIO(content), name, cipher))
+    elif cipher is not None:
+        content = cipher.decrypt(name, content)
+    if flags & (FLAG_GZIP | FLAG_LZ4) != 0:
+        content = _decompress(content, flags)
+    return content
 
 
 class FileWrapper:
-    def __init__(self, file, offset, length, flags):
+    def __init__(self, file, offset, length, flags, name=None, cipher=None):
         self.file = file
         self.offset = offset
         self.length = length
         self.flags = flags
+        self.name = name
+        self.cipher = cipher
 
         self.pos = 0
+        self.decompressed = None
+        # Kept after the cache is dropped, so reads at the end return b""
+        # without decoding the content again.
+        self.decoded_len = None
+
+        # Split content is decoded one block at a time, see `_read_split`.
+        self.block_size = None
+        self.block_offsets = None
+        self.block = None
+
+    def _load_block_table(self):
+        if self.block_offsets is not None:
+            return
+
+        self.file.seek(self.offset)
+        self.block_size, block_lens = _read_split_table(
+            self.file, self.length, self.name
+        )
+
+        offset = self.offset + 8 + 4 * len(block_lens)
+        self.block_offsets = []
+        for block_len in block_lens:
+            self.block_offsets.append((offset, block_len))
+            offset += block_len
+
+    def _split_block(self, index):
+        if self.block is None or self.block[0] != index:
+            offset, block_len = self.block_offsets[index]
+            self.file.seek(offset)
+            raw = self.file.read(block_len)
+            self.block = (
+                index,
+                _decode_split_block(
+                    raw,
+                    self.flags,
+                    self.name,
+                    self.cipher,
+                    index,
+                    index == len(self.block_offsets) - 1,
+                    self.block_size,
+                ),
+            )
+        return self.block[1]
+
+    def _read_split(self, size):
+        """Reads split content by decoding only the blocks that `size` bytes
+        from the current position touch."""
+        self._load_block_table()
+
+        chunks = []
+        while size > 0:
+            index, within = divmod(self.pos, self.block_size)
+            if index >= len(self.block_offsets):
+                break
+
+            chunk = self._split_block(index)[within : within + size]
+            if len(chunk) == 0:
+                break
+
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+
+        return b"".join(chunks)
 
     def _compute_cache(self):
+        if self.decompressed is not None:
+            return
+
         self.file.seek(self.offset)
         compressed = self.file.read(self.length)
-
-        if self.flags & FLAG_GZIP != 0:
-            self.decompressed = gzip.decompress(compressed)
-        elif self.flags & FLAG_LZ4 != 0:
-            self.decompressed = lz4.frame.decompress(compressed)
-        else:
-            assert False
+        self.decompressed = _decode(compressed, self.flags, self.name, self.cipher)
+        self.decoded_len = len(self.decompressed)
 
     def _clear_cache(self):
         self.decompressed = None
 
     def read(self, size):
 
-        if (self.flags & FLAG_GZIP != 0) or (self.flags & FLAG_LZ4 != 0):
+        if self.flags & FLAG_SPLIT != 0:
+            return self._read_split(size)
+        elif _is_transformed(self.flags):
+            if self.decoded_len is not None and self.pos >= self.decoded_len:
+                return b""
             self._compute_cache()
             to_read = min(size, len(self.decompressed) - self.pos)
             result = self.decompressed[self.pos : self.pos + to_read]
             self.pos += to_read
-            if self.pos == self.length:
+            if self.pos == len(self.decompressed):
                 self._clear_cache()
             return result
         else:
@@ -51,35 +230,242 @@ class FileWrapper:
         self.pos = pos
 
 
-class Unarchiver:
-    def __init__(self, file):
+def _read_exactly(file, size):
+    """Reads `size` bytes from a possibly short-reading stream. Returns fewer
+    bytes only at the end of the stream."""
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class StreamWrapper:
+    """Forward-only reader of a file's content within a streamed archive.
+
+    Compressed content is decompressed incrementally as it is read from the
+    underlying stream. The content must be read (or `skip`ped) to the end
+    before the next file of the archive can be read.
+
+    `length` is None for chunked content, which is read block by block. Split
+    content is also decoded block by block."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file, length, flags, name=None, cipher=None):
         self.file = file
+        self.remaining = length
+        self.flags = flags
+        self.buffer = b""
 
-    def files(self):
-        results = []
+        # Encrypted content can only be authenticated as a whole, so it is
+        # buffered and decoded in one go on the first read. Chunked content
+        # is authenticated block by block instead.
+        self.name = name
+        self.cipher = cipher
 
-        self.file.seek(0)
+        self.blocks = None
+        if length is None:
+            self.blocks = _blocks(file, name, cipher)
+            self.cipher = None
+            self.remaining = 0
+
+        self.split_blocks = None
+        if flags & FLAG_SPLIT != 0:
+            self.split_blocks = self._split_blocks()
+
+        if self.split_blocks is not None or self.cipher is not None:
+            self.decompressor = None
+        elif flags & FLAG_GZIP != 0:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif flags & FLAG_LZ4 != 0:
+            self.decompressor = lz4.frame.LZ4FrameDecompressor()
+        else:
+            self.decompressor = None
+
+    def _read_raw(self, size):
+        chunk = self.file.read(min(size, self.remaining))
+        if len(chunk) == 0:
+            raise RuntimeError("Unexpected end of archive.")
+        self.remaining -= len(chunk)
+        return chunk
+
+    def _read_raw_exactly(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self._read_raw(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _split_blocks(self):
+        block_size, block_lens = _read_split_table(self.file, self.remaining, self.name)
+        self.remaining -= 8 + 4 * len(block_lens)
+
+        for index, block_len in enumerate(block_lens):
+            yield _decode_split_block(
+                self._read_raw_exactly(block_len),
+                self.flags,
+                self.name,
+                self.cipher,
+                index,
+                index == len(block_lens) - 1,
+                block_size,
+            )
+
+    def read(self, size):
+        if self.split_blocks is not None:
+            while len(self.buffer) < size:
+                block = next(self.split_blocks, None)
+                if block is None:
+                    break
+                self.buffer += block
+
+            result = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return result
+
+        if self.cipher is not None:
+            if self.remaining > 0:
+                raw = _read_exactly(self.file, self.remaining)
+                if len(raw) != self.remaining:
+                    raise RuntimeError("Unexpected end of archive.")
+                self.remaining = 0
+                self.buffer = _decode(raw, self.flags, self.name, self.cipher)
+
+            result = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return result
+
+        if self.decompressor is None and self.blocks is None:
+            if self.remaining == 0:
+                return b""
+            return self._read_raw(size)
+
+        while len(self.buffer) < size:
+            if self.blocks is not None:
+                raw = next(self.blocks, None)
+                if raw is None:
+                    break
+            elif self.remaining > 0:
+                raw = self._read_raw(self.CHUNK_SIZE)
+            else:
+                break
+
+            if self.decompressor is not None:
+                raw = self.decompressor.decompress(raw)
+            self.buffer += raw
 
-        if self.file.read(4) != MAGIC:
+        result = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return result
+
+    def skip(self):
+        """Discards the rest of the content without decompressing it."""
+        if self.blocks is not None:
+            for _ in self.blocks:
+                pass
+        while self.remaining > 0:
+            self._read_raw(self.CHUNK_SIZE)
+        self.buffer = b""
+
+
+class Unarchiver:
+    def __init__(self, file, key=None):
+        self.file = file
+        self.key = key
+
+    def _read_header(self):
+        if _read_exactly(self.file, 4) != MAGIC:
             raise RuntimeError("Invalid magic bytes.")
 
-        flags = struct.unpack("<L", self.file.read(4))[0]
+        flags = struct.unpack("<L", _read_exactly(self.file, 4))[0]
 
-        if self.file.read(28) != b"\x00" * 28:
+        if _read_exactly(self.file, 28) != b"\x00" * 28:
             raise RuntimeError("Invalid header padding bytes.")
 
+        return flags
+
+    def _read_member_header(self, flags):
+        """Returns `(name, content_len)` of the next file, or None at the end
+        of the archive. `content_len` is None for chunked content, which
+        follows the name directly."""
+        name_len_bytes = _read_exactly(self.file, 4)
+
+        if name_len_bytes == b"":
+            return None
+        if len(name_len_bytes) != 4:
+            raise RuntimeError("Unexpected end of archive.")
+
+        name_len = struct.unpack("<L", name_len_bytes)[0]
+        name = _read_exactly(self.file, name_len).decode()
+
+        if flags & FLAG_CHUNKED != 0:
+            return name, None
+
+        content_len_bytes = _read_exactly(self.file, 8)
+        if len(content_len_bytes) != 8:
+            raise RuntimeError("Unexpected end of archive.")
+
+        return name, struct.unpack("<Q", content_len_bytes)[0]
+
+    def stream(self):
+        """Yields `(name, StreamWrapper)` for every file while reading the
+        archive strictly forward, so `file` only needs a `read` method (e.g.
+        stdin or a botocore `StreamingBody`). Each wrapper is only valid until
+        the next one is yielded."""
+        flags = self._read_header()
+        cipher = MemberCipher.for_flags(flags, self.key)
+
         while True:
-            name_len_bytes = self.file.read(4)
+            header = self._read_member_header(flags)
+            if header is None:
+                return
+
+            name, content_len = header
+            wrapper = StreamWrapper(self.file, content_len, flags, name, cipher)
+            yield name, wrapper
+            wrapper.skip()
 
-            if name_len_bytes == b"":
+    def members(self):
+        """Returns `(name, offset, length, flags)` for every file in the
+        archive, where `offset` and `length` locate its stored content."""
+        results = []
+
+        self.file.seek(0)
+        flags = self._read_header()
+
+        while True:
+            header = self._read_member_header(flags)
+            if header is None:
                 return results
 
-            name_len = struct.unpack("<L", name_len_bytes)[0]
-            name = self.file.read(name_len).decode()
+            name, content_len = header
+            offset = self.file.tell()
+            if content_len is None:
+                # Walks the block lengths without reading the blocks.
+                while True:
+                    block_len = _read_block_len(self.file)
+                    if block_len == 0:
+                        break
+                    self.file.seek(block_len, 1)
+                content_len = self.file.tell() - offset
+            else:
+                self.file.seek(content_len, 1)
+            results.append((name, offset, content_len, flags))
 
-            content_len = struct.unpack("<Q", self.file.read(8))[0]
+    def files(self):
+        results = []
+        cipher = None
 
+        for name, offset, length, flags in self.members():
+            if cipher is None:
+                cipher = MemberCipher.for_flags(flags, self.key)
             results.append(
-                (name, FileWrapper(self.file, self.file.tell(), content_len, flags))
+                (name, FileWrapper(self.file, offset, length, flags, name, cipher))
             )
-            self.file.seek(content_len, 1)
+
+        return results
@@ -0,0 +1,299 @@
+import logging
+import os
+import mmap
+import errno
+import threading
+
+# O_DIRECT requires offsets, lengths and buffers aligned to the logical block
+# size of the device; 4 KiB covers every common disk.
+DIRECT_ALIGNMENT = 4096
+DIRECT_CHUNK_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger("bandreader")
+
+
+def _fadvise(fd, advice, offset=0, length=0):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, advice)
+
+
+class BufferPool:
+    """Aligned buffers for O_DIRECT reads, shared by the band files of a
+    `BandReader`.
+
+    A buffer is only taken for the duration of a read, so there are only as
+    many as there are concurrent reads, however many band files are open."""
+
+    def __init__(self):
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        # Anonymous mappings are page aligned.
+        return mmap.mmap(-1, DIRECT_CHUNK_SIZE)
+
+    def release(self, buffer):
+        with self._lock:
+            self._free.append(buffer)
+
+    def close(self):
+        with self._lock:
+            for buffer in self._free:
+                buffer.close()
+            self._free = []
+
+
+class BandFile:
+    """Read-only band file opened by a `BandReader`.
+
+    Supports the subset of the file interface the archiver and uploader use:
+    `read`, `seek`, `tell`, `fileno`, `close` and `name`. With `direct`, the
+    file is read with O_DIRECT through an aligned buffer from `buffers`,
+    bypassing the page cache altogether."""
+
+    def __init__(self, path, drop_cache=False, direct=False, buffers=None):
+        self.name = path
+        self.drop_cache = drop_cache
+        self.direct = False
+        self.pos = 0
+        self.buffers = buffers if buffers is not None else BufferPool()
+
+        if direct:
+            try:
+                self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+                self.direct = True
+            except OSError as ex:
+                if ex.errno != errno.EINVAL:
+                    raise
+                logger.warning(
+                    "O_DIRECT is not supported for %s -- using buffered reads", path
+                )
+        if not self.direct:
+            self.fd = os.open(path, os.O_RDONLY)
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = pos
+        elif whence == os.SEEK_CUR:
+            self.pos += pos
+        else:
+            self.pos = os.fstat(self.fd).st_size + pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def _read_direct(self, size):
+        buffer = self.buffers.acquire()
+        try:
+            return self._read_direct_into(buffer, size)
+        finally:
+            self.buffers.release(buffer)
+
+    def _read_direct_into(self, buffer, size):
+        chunks = []
+        while size > 0:
+            start = self.pos - self.pos % DIRECT_ALIGNMENT
+            skip = self.pos - start
+            length = min(size + skip, DIRECT_CHUNK_SIZE)
+            length += -length % DIRECT_ALIGNMENT
+
+            view = memoryview(buffer)[:length]
+            try:
+                read = os.preadv(self.fd, [view], start)
+            except OSError as ex:
+                view.release()
+                if ex.errno != errno.EINVAL:
+                    raise
+                # Some filesystems accept O_DIRECT on open but not on read.
+                logger.warning(
+                    "O_DIRECT read failed for %s -- using buffered reads", self.name
+                )
+                self._reopen_buffered()
+                chunks.append(self._read_buffered(size))
+                break
+
+            chunk = bytes(view[skip : min(read, skip + size)])
+            view.release()
+            if len(chunk) == 0:
+                break
+
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+
+        return b"".join(chunks)
+
+    def _reopen_buffered(self):
+        fd = os.open(self.name, os.O_RDONLY)
+        os.close(self.fd)
+        self.fd = fd
+        self.direct = False
+
+    def _read_buffered(self, size):
+        chunks = []
+        while size > 0:
+            chunk = os.pread(self.fd, size, self.pos)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, os.fstat(self.fd).st_size - self.pos)
+
+        if self.direct:
+            return self._read_direct(size)
+        return self._read_buffered(size)
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        if self.drop_cache and not self.direct:
+            _fadvise(self.fd, getattr(os, "POSIX_FADV_DONTNEED", 0))
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BandReader:
+    """Opens band files, keeping the page cache of the host in mind.
+
+    Bands `schedule`d in the order they will be read are prefetched by a
+    background thread with `POSIX_FADV_WILLNEED`, keeping up to `readahead`
+    bytes ahead of the band last opened, so that the disk stays busy while
+    bands are compressed and uploaded. With `drop_cache`, a band's pages are
+    dropped with `POSIX_FADV_DONTNEED` once it is closed, so a backup does not
+    evict the working set of everything else on the host. With `direct_io`,
+    bands bypass the page cache entirely and prefetching is disabled.
+
+    All of these are no-ops on platforms without `posix_fadvise`."""
+
+    def __init__(self, readahead=0, drop_cache=False, direct_io=False):
+        self.readahead = readahead
+        self.drop_cache = drop_cache
+        self.direct_io = direct_io
+
+        if direct_io and not hasattr(os, "O_DIRECT"):
+            raise RuntimeError("O_DIRECT is not supported on this platform.")
+
+        self.buffers = BufferPool()
+
+        # Scheduled paths not consumed yet. Positions count every path ever
+        # scheduled, and `_order` starts at position `_base`.
+        self._order = []
+        self._base = 0
+        self._positions = {}
+        self._sizes = {}
+        self._next = 0
+        self._consumed = 0
+        self._ahead = 0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def _prefetching(self):
+        return (
+            self.readahead > 0
+            and not self.direct_io
+            and hasattr(os, "POSIX_FADV_WILLNEED")
+        )
+
+    def schedule(self, paths):
+        """Queues `paths` for prefetching, in the order they will be
+        opened."""
+        if not self._prefetching():
+            return
+
+        with self._cond:
+            for path in paths:
+                self._positions[path] = self._base + len(self._order)
+                self._order.append(path)
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._prefetch_loop, name="band-prefetch", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _prefetch_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and (
+                    self._next >= self._base + len(self._order)
+                    or self._ahead >= self.readahead
+                ):
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+                index = self._next
+                path = self._order[index - self._base]
+                self._next += 1
+
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    size = os.fstat(fd).st_size
+                    _fadvise(fd, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                # The band may be gone by now; the reader will find out.
+                size = 0
+
+            with self._cond:
+                if index >= self._consumed:
+                    self._sizes[index] = size
+                    self._ahead += size
+
+    def _consume(self, path):
+        with self._cond:
+            index = self._positions.get(path)
+            if index is None or index < self._consumed:
+                return
+
+            for done in range(self._consumed, index + 1):
+                self._ahead -= self._sizes.pop(done, 0)
+            self._consumed = index + 1
+            self._next = max(self._next, self._consumed)
+
+            # Forgets consumed paths, which a watching process would
+            # otherwise accumulate forever.
+            for done, done_path in enumerate(
+                self._order[: self._consumed - self._base], self._base
+            ):
+                if self._positions.get(done_path) == done:
+                    del self._positions[done_path]
+            del self._order[: self._consumed - self._base]
+            self._base = self._consumed
+
+            self._cond.notify()
+
+    def open(self, path):
+        self._consume(path)
+        return BandFile(path, self.drop_cache, self.direct_io, self.buffers)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.buffers.close()
@@ -0,0 +1,277 @@
+import logging
+import os
+import glob
+import json
+import time
+import threading
+import concurrent.futures
+
+import boto3
+import botocore.config
+
+from arc.crypto import CIPHERS, MemberCipher, load_key
+
+from .bandreader import BandReader
+from .storage import open_backend
+from .uploader import Uploader
+
+BUNDLE_DEFAULTS = {
+    "package_size": 0x100,
+    "storage_class": "DEEP_ARCHIVE",
+    "gzip": False,
+    "lz4": False,
+    "chunked": False,
+    "block_size": None,
+    "cache_chunks": False,
+    "part_size": 64,
+    "legacy_checksums": False,
+    "encrypt": None,
+    "key_file": None,
+    "readahead": 0,
+    "drop_cache": False,
+    "direct_io": False,
+}
+
+
+def load_config(path):
+    """Loads a batch config file.
+
+    The file is a JSON object whose `bundles` list describes one bundle
+    each, e.g.:
+
+        {
+            "bundles": [
+                {
+                    "bundle": "/vms/a.sparsebundle",
+                    "tmpdir": "/var/tmp/a",
+                    "destination": "s3://backups/a",
+                    "lz4": true
+                }
+            ]
+        }
+
+    `bundle`, `tmpdir` and `destination` are required. Every other key of
+    `BUNDLE_DEFAULTS` may be given per bundle, or once at the top level to
+    apply to all bundles."""
+    with open(path, "r") as file:
+        config = json.load(file)
+
+    if not isinstance(config.get("bundles"), list):
+        raise RuntimeError("Batch config must contain a list of `bundles`.")
+
+    defaults = dict(BUNDLE_DEFAULTS)
+    for key in BUNDLE_DEFAULTS:
+        if key in config:
+            defaults[key] = config[key]
+
+    entries = []
+    for entry in config["bundles"]:
+        for key in ["bundle", "tmpdir", "destination"]:
+            if key not in entry:
+                raise RuntimeError("Batch bundle is missing `{}`.".format(key))
+
+        unknown = (
+            set(entry) - set(BUNDLE_DEFAULTS) - {"bundle", "tmpdir", "destination"}
+        )
+        if unknown:
+            raise RuntimeError(
+                "Unknown batch bundle options: {}".format(", ".join(sorted(unknown)))
+            )
+
+        merged = dict(defaults)
+        merged.update(entry)
+        entries.append(merged)
+
+    return entries
+
+
+class BundleSummary:
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.packages = 0
+        self.failed = 0
+        self.error = None
+        self.start = None
+        self.end = None
+
+
+class BatchRunner:
+    """Uploads many bundles from a single process.
+
+    All bundles share one thread pool, which both compresses and uploads,
+    one pool of `block_jobs` threads compressing split blocks, one pooled
+    S3 client and the optional chunk cache. Packages are scheduled
+    round-robin across bundles, so that a large bundle does not hold up the
+    others and the pool stays busy with a mix of compression and network
+    work."""
+
+    def __init__(self, entries, jobs, for_real, cache, block_jobs=None):
+        self.entries = entries
+        self.jobs = jobs
+        self.for_real = for_real
+        self.cache = cache
+        # Defaults to a thread per core, as with sparsebundle-s3.
+        self.block_jobs = block_jobs or os.cpu_count() or 1
+
+        self.logger = logging.getLogger("batch")
+        self._lock = threading.Lock()
+
+    def _make_uploader(self, entry, client, block_executor):
+        backend, name = open_backend(entry["destination"], client)
+
+        cipher = None
+        if entry["encrypt"] is not None:
+            key = load_key(entry["key_file"])
+            if key is None:
+                raise RuntimeError("No encryption key for {}".format(entry["bundle"]))
+            cipher = MemberCipher(CIPHERS[entry["encrypt"]], key)
+
+        os.makedirs(entry["tmpdir"], exist_ok=True)
+        bundle_files = list(
+            glob.glob(os.path.join(entry["bundle"], "**"), recursive=True)
+        )
+
+        return Uploader(
+            entry["bundle"],
+            bundle_files,
+            entry["package_size"],
+            entry["gzip"],
+            entry["lz4"],
+            entry["cache_chunks"],
+            entry["tmpdir"],
+            backend,
+            name,
+            entry["storage_class"],
+            self.for_real,
+            part_size=entry["part_size"] * 1024 * 1024,
+            cache=self.cache,
+            legacy_checksums=entry["legacy_checksums"],
+            cipher=cipher,
+            band_reader=BandReader(
+                entry["readahead"] * 1024 * 1024,
+                entry["drop_cache"],
+                entry["direct_io"],
+            ),
+            chunked=entry["chunked"],
+            block_size=(
+                entry["block_size"] * 1024 if entry["block_size"] is not None else None
+            ),
+            block_jobs=self.block_jobs,
+            block_executor=block_executor,
+        )
+
+    def _prepare(self, entry, client, block_executor, summary):
+        summary.start = time.perf_counter()
+        uploader = self._make_uploader(entry, client, block_executor)
+        packages = uploader.prepare()
+        uploader.schedule_packages(packages)
+        return uploader, packages
+
+    def _upload_package(self, uploader, package_id, bands, summary):
+        try:
+            uploader.upload_package(package_id, bands)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.error(
+                "Package %s of %s failed: %s",
+                format(package_id, "x"),
+                summary.bundle,
+                ex,
+                exc_info=True,
+            )
+            with self._lock:
+                summary.failed += 1
+        finally:
+            with self._lock:
+                summary.end = time.perf_counter()
+
+    def run(self):
+        """Uploads every bundle and returns their `BundleSummary`s."""
+        client = boto3.client(
+            "s3",
+            config=botocore.config.Config(max_pool_connections=max(10, 2 * self.jobs)),
+        )
+        summaries = [BundleSummary(entry["bundle"]) for entry in self.entries]
+
+        # Outlives `pool`, whose tasks compress blocks on it.
+        block_pool = concurrent.futures.ThreadPoolExecutor(self.block_jobs)
+        with block_pool, concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            prepare_futures = [
+                pool.submit(self._prepare, entry, client, block_pool, summary)
+                for entry, summary in zip(self.entries, summaries)
+            ]
+
+            prepared = []
+            for future, summary in zip(prepare_futures, summaries):
+                try:
+                    uploader, packages = future.result()
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.logger.error(
+                        "Bundle %s failed: %s", summary.bundle, ex, exc_info=True
+                    )
+                    summary.error = ex
+                    continue
+
+                summary.packages = len(packages)
+                queue = [
+                    (package_id, packages[package_id])
+                    for package_id in sorted(packages.keys())
+                ]
+                prepared.append((uploader, summary, queue))
+
+            # Round-robin across bundles; the pool runs tasks in submission
+            # order.
+            package_futures = []
+            for index in range(max([len(q) for _, _, q in prepared] + [0])):
+                for uploader, summary, queue in prepared:
+                    if index < len(queue):
+                        package_id, bands = queue[index]
+                        package_futures.append(
+                            pool.submit(
+                                self._upload_package,
+                                uploader,
+                                package_id,
+                                bands,
+                                summary,
+                            )
+                        )
+            concurrent.futures.wait(package_futures)
+
+            finish_futures = [
+                (pool.submit(uploader.finish), summary)
+                for uploader, summary, _ in prepared
+            ]
+            for future, summary in finish_futures:
+                try:
+                    future.result()
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.logger.error(
+                        "Catalog upload of %s failed: %s",
+                        summary.bundle,
+                        ex,
+                        exc_info=True,
+                    )
+                    summary.error = ex
+
+        for uploader, summary, _ in prepared:
+            if summary.end is None:
+                summary.end = time.perf_counter()
+            self.logger.info(
+                "%s: %d packages, %d of %d files uploaded (%.1f MiB), "
+                "%d failed, %.1fs",
+                summary.bundle,
+                summary.packages,
+                uploader.stats["uploaded"],
+                uploader.stats["files"],
+                uploader.stats["uploaded_bytes"] / 1024 / 1024,
+                summary.failed,
+                summary.end - summary.start,
+            )
+
+        if self.cache is not None:
+            self.logger.info(
+                "Chunk cache: %(hits)d hits, %(misses)d misses, "
+                "%(evictions)d evictions, %(spills)d spills",
+                self.cache.stats(),
+            )
+
+        return summaries
@@ -0,0 +1,369 @@
+import collections
+import os
+import re
+import struct
+import threading
+
+CATALOG_MAGIC = b"arcc"
+
+CatalogEntry = collections.namedtuple(
+    "CatalogEntry", ["name", "md5", "size", "uncompressed_size", "generation"]
+)
+
+# Number of incremental segments after which they are merged into a base.
+COMPACT_THRESHOLD = 16
+
+_SEGMENT_RE = re.compile(r"^(base|segment)-([0-9a-f]{8})\.cat$")
+_LOG_RE = re.compile(r"^segment-([0-9a-f]{8})\.log$")
+
+
+def segment_filename(kind, generation):
+    return "{}-{:08x}.cat".format(kind, generation)
+
+
+def log_filename(generation):
+    return "segment-{:08x}.log".format(generation)
+
+
+def parse_segment_filename(filename):
+    """Returns `(kind, generation)` for a segment file name, or None."""
+    match = _SEGMENT_RE.match(filename)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2), 16)
+
+
+def encode_record(entry):
+    name = entry.name.encode()
+    md5 = entry.md5.encode()
+    return (
+        struct.pack("<L", len(name))
+        + name
+        + struct.pack("<B", len(md5))
+        + md5
+        + struct.pack("<QQL", entry.size, entry.uncompressed_size, entry.generation)
+    )
+
+
+def decode_record(data, offset):
+    """Returns the entry recorded at `offset` of `data`, and the offset after
+    it. Raises `struct.error` or `IndexError` if the record is truncated."""
+    name_len = struct.unpack_from("<L", data, offset)[0]
+    offset += 4
+    name = data[offset : offset + name_len]
+    offset += name_len
+    md5_len = data[offset]
+    offset += 1
+    md5 = data[offset : offset + md5_len]
+    offset += md5_len
+    if len(name) != name_len or len(md5) != md5_len:
+        raise IndexError("Truncated catalog record.")
+    size, uncompressed_size, generation = struct.unpack_from("<QQL", data, offset)
+    offset += 20
+    entry = CatalogEntry(
+        name.decode(), md5.decode(), size, uncompressed_size, generation
+    )
+    return entry, offset
+
+
+class Segment:
+    """Immutable, sorted run of catalog entries.
+
+    A segment is composed of a header, an offset table and a stream of
+    records sorted by name.
+
+    The header contains the following fields:
+
+    1. magic,       4           bytes (always "arcc")
+    2. generation,  4           bytes (little endian)
+    3. count,       8           bytes (little endian)
+
+    The offset table holds `count` 8-byte little endian offsets, from the
+    start of the segment, of each record. Each record contains:
+
+    1. name_len,    4           bytes (little endian)
+    2. name,        name_len    bytes
+    3. md5_len,     1           byte
+    4. md5,         md5_len     bytes (hex MD5, or S3 multipart ETag)
+    5. size,        8           bytes (little endian)
+    6. uncomp_size, 8           bytes (little endian)
+    7. generation,  4           bytes (little endian)
+
+    The offset table allows looking up a name with a binary search."""
+
+    HEADER = struct.Struct("<4sLQ")
+
+    def __init__(self, data):
+        magic, self.generation, self.count = self.HEADER.unpack_from(data, 0)
+        if magic != CATALOG_MAGIC:
+            raise RuntimeError("Invalid catalog magic bytes.")
+
+        self.data = data
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            return cls(file.read())
+
+    @classmethod
+    def encode(cls, generation, entries):
+        entries = sorted(entries, key=lambda entry: entry.name)
+        records = []
+        offsets = []
+        pos = cls.HEADER.size + 8 * len(entries)
+
+        for entry in entries:
+            record = encode_record(entry)
+            offsets.append(pos)
+            records.append(record)
+            pos += len(record)
+
+        return (
+            cls.HEADER.pack(CATALOG_MAGIC, generation, len(entries))
+            + struct.pack("<{}Q".format(len(offsets)), *offsets)
+            + b"".join(records)
+        )
+
+    def _offset(self, index):
+        return struct.unpack_from("<Q", self.data, self.HEADER.size + 8 * index)[0]
+
+    def _name(self, index):
+        offset = self._offset(index)
+        name_len = struct.unpack_from("<L", self.data, offset)[0]
+        return self.data[offset + 4 : offset + 4 + name_len].decode()
+
+    def _entry(self, index):
+        return decode_record(self.data, self._offset(index))[0]
+
+    def lookup(self, name):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._name(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < self.count and self._name(low) == name:
+            return self._entry(low)
+        return None
+
+    def entries(self):
+        for index in range(self.count):
+            yield self._entry(index)
+
+
+class Catalog:
+    """Checksum catalog of uploaded objects, kept as a set of segments under
+    `directory`.
+
+    Every run writes its entries into its own `segment-<generation>.cat`, so
+    only that segment needs uploading. Entries are appended to
+    `segment-<generation>.log` as they are added, and the segment is only
+    encoded on `flush`; a log left behind by an interrupted run is turned
+    into its segment on the next load. Once more than `COMPACT_THRESHOLD`
+    segments accumulate they are merged into a `base-<generation>.cat`
+    holding the newest entry of every name; the base supersedes all
+    segments up to its generation. Lookups search the current run, then the
+    segments from newest to oldest, then the base."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.base = None
+        self.segments = []
+        self.pending = {}
+
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+        if self.segments:
+            self.generation = self.segments[-1].generation + 1
+        elif self.base is not None:
+            self.generation = self.base.generation + 1
+        else:
+            self.generation = 1
+
+    def _replay_logs(self):
+        for filename in os.listdir(self.directory):
+            match = _LOG_RE.match(filename)
+            if match is None:
+                continue
+
+            generation = int(match.group(1), 16)
+            entries = {}
+            segment_path = os.path.join(
+                self.directory, segment_filename("segment", generation)
+            )
+            if os.path.exists(segment_path):
+                for entry in Segment.load(segment_path).entries():
+                    entries[entry.name] = entry
+
+            log_path = os.path.join(self.directory, filename)
+            with open(log_path, "rb") as file:
+                data = file.read()
+
+            offset = 0
+            while offset < len(data):
+                try:
+                    entry, offset = decode_record(data, offset)
+                except (struct.error, IndexError):
+                    # The last record was torn by the interruption.
+                    break
+                entries[entry.name] = entry
+
+            self._write(
+                segment_filename("segment", generation),
+                Segment.encode(generation, entries.values()),
+            )
+            os.remove(log_path)
+
+    def _load(self):
+        self._replay_logs()
+
+        found = []
+        for filename in os.listdir(self.directory):
+            parsed = parse_segment_filename(filename)
+            if parsed is not None:
+                found.append((parsed[1], parsed[0] == "segment", filename))
+
+        base_generation = -1
+        for generation, is_segment, filename in sorted(found):
+            if not is_segment:
+                base_generation = generation
+
+        for generation, is_segment, filename in sorted(found):
+            path = os.path.join(self.directory, filename)
+            if generation < base_generation or (
+                generation == base_generation and is_segment
+            ):
+                os.remove(path)
+            elif not is_segment:
+                self.base = Segment.load(path)
+            else:
+                self.segments.append(Segment.load(path))
+
+    def _write(self, filename, data):
+        path = os.path.join(self.directory, filename)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def segment_path(self):
+        """Returns the path of this run's segment, or None if nothing has been
+        added in this run. The segment is only up to date after `flush`."""
+        if not self.pending:
+            return None
+        return os.path.join(
+            self.directory, segment_filename("segment", self.generation)
+        )
+
+    def base_path(self):
+        if self.base is None:
+            return None
+        return os.path.join(
+            self.directory, segment_filename("base", self.base.generation)
+        )
+
+    def add(self, name, md5, size, uncompressed_size):
+        """Records an uploaded object and appends it to this run's log."""
+        with self._lock:
+            entry = CatalogEntry(name, md5, size, uncompressed_size, self.generation)
+            self.pending[name] = entry
+            self._append([entry])
+
+    def _log_path(self):
+        return os.path.join(self.directory, log_filename(self.generation))
+
+    def _append(self, entries):
+        with open(self._log_path(), "ab") as file:
+            file.write(b"".join(encode_record(entry) for entry in entries))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def flush(self):
+        """Encodes this run's segment from the entries added so far, and drops
+        the log they were appended to."""
+        with self._lock:
+            if not self.pending:
+                return
+
+            self._write(
+                segment_filename("segment", self.generation),
+                Segment.encode(self.generation, self.pending.values()),
+            )
+            if os.path.exists(self._log_path()):
+                os.remove(self._log_path())
+
+    def lookup(self, name):
+        with self._lock:
+            if name in self.pending:
+                return self.pending[name]
+
+        for segment in reversed(self.segments):
+            entry = segment.lookup(name)
+            if entry is not None:
+                return entry
+
+        if self.base is not None:
+            return self.base.lookup(name)
+        return None
+
+    def entries(self):
+        """Returns the newest entry of every name, sorted by name."""
+        merged = {}
+        sources = ([self.base] if self.base is not None else []) + self.segments
+        for segment in sources:
+            for entry in segment.entries():
+                merged[entry.name] = entry
+
+        with self._lock:
+            merged.update(self.pending)
+
+        return [merged[name] for name in sorted(merged)]
+
+    def compact(self, force=False):
+        """Merges all segments, including this run's, into a new base if there
+        are more than `COMPACT_THRESHOLD` of them. Returns whether it did."""
+        segment_count = len(self.segments) + (1 if self.pending else 0)
+        if segment_count == 0 or (not force and segment_count <= COMPACT_THRESHOLD):
+            return False
+
+        generation = self.generation if self.pending else self.segments[-1].generation
+        self._write(
+            segment_filename("base", generation),
+            Segment.encode(generation, self.entries()),
+        )
+
+        self.segments = []
+        with self._lock:
+            self.pending = {}
+            if os.path.exists(self._log_path()):
+                os.remove(self._log_path())
+        self._load()
+
+        # Entries added after compaction must not be superseded by the base.
+        self.generation = generation + 1
+        return True
+
+    def import_text(self, path):
+        """Imports a legacy `checksums.txt`, where later lines supersede
+        earlier ones. Sizes are unknown and recorded as 0."""
+        with open(path, "r") as file, self._lock:
+            entries = []
+            for line in file:
+                parts = line.strip().split(" ", 1)
+                if len(parts) == 2:
+                    entry = CatalogEntry(parts[1], parts[0], 0, 0, self.generation)
+                    self.pending[parts[1]] = entry
+                    entries.append(entry)
+            self._append(entries)
+
+    def export_text(self, file):
+        """Writes the catalog in the legacy `checksums.txt` format."""
+        for entry in self.entries():
+            file.write("{} {}\n".format(entry.md5, entry.name))
@@ -0,0 +1,374 @@
+import logging
+import os
+import struct
+import bisect
+import plistlib
+import threading
+import collections
+import concurrent.futures
+
+from arc.crypto import MemberCipher
+from arc.unarchiver import FileWrapper, Unarchiver, _read_exactly
+
+
+class RangedFile:
+    """Seekable, read-only file over an object, read with ranged GETs.
+
+    Small reads, such as the member headers `Unarchiver.members` walks, are
+    served from `block_size` blocks so that neighbouring headers cost one
+    request; larger reads go straight to the store."""
+
+    def __init__(self, backend, key, size, block_size=64 * 1024):
+        self.backend = backend
+        self.key = key
+        self.size = size
+        self.block_size = block_size
+        self.pos = 0
+
+        self.block_start = None
+        self.block = b""
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = pos
+        elif whence == os.SEEK_CUR:
+            self.pos += pos
+        else:
+            self.pos = self.size + pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = max(0, min(size, self.size - self.pos))
+        if size == 0:
+            return b""
+
+        if size > self.block_size:
+            result = self.backend.get_range(self.key, self.pos, size)
+        else:
+            if (
+                self.block_start is None
+                or self.pos < self.block_start
+                or self.pos + size > self.block_start + len(self.block)
+            ):
+                self.block_start = self.pos
+                self.block = self.backend.get_range(
+                    self.key, self.pos, min(self.block_size, self.size - self.pos)
+                )
+            offset = self.pos - self.block_start
+            result = self.block[offset : offset + size]
+
+        self.pos += len(result)
+        return result
+
+
+class BundleImage:
+    """Read-only view of an uploaded sparse bundle as one flat disk image.
+
+    The image size and band size come from the uploaded `Info.plist`, and
+    the band range of every package from the names of the uploaded
+    packages. A read is mapped to bands, bands to packages, and only the
+    members holding those bands are fetched and decompressed. The member
+    index of every package touched is kept, and the last `cache_bands`
+    decompressed bands are kept in an LRU cache. When reads are sequential,
+    the next `prefetch` bands are fetched in the background.
+
+    Bands missing from the backup read as zeros, as they do in the bundle.
+    Objects in archival storage classes must be restored before they can be
+    read."""
+
+    def __init__(self, backend, name, key=None, cache_bands=16, prefetch=2):
+        self.backend = backend
+        self.name = name
+        self.key = key
+        self.cache_bands = cache_bands
+        self.prefetch = prefetch
+
+        self.logger = logging.getLogger("image")
+
+        plist = plistlib.loads(self.backend.get_range("{}/Info.plist".format(name), 0))
+        self.band_size = plist["band-size"]
+        self.size = plist["size"]
+
+        self.package_starts = []
+        self.packages = []
+        self._list_packages()
+
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._bands = collections.OrderedDict()
+        self._pending = {}
+        self._last_band = None
+        self._pool = (
+            concurrent.futures.ThreadPoolExecutor(prefetch) if prefetch > 0 else None
+        )
+
+    def _list_packages(self):
+        prefix = "{}/bands/".format(self.name)
+        found = []
+        for info in self.backend.list(prefix):
+            filename = info.key[len(prefix) :]
+            if not filename.endswith(".arc"):
+                continue
+            try:
+                first, last = [int(x, 16) for x in filename[: -len(".arc")].split("-")]
+            except ValueError:
+                continue
+            found.append((first, last, info.key, info.size))
+
+        found.sort()
+        self.package_starts = [first for first, _, _, _ in found]
+        self.packages = found
+
+    def _package_for(self, band):
+        index = bisect.bisect_right(self.package_starts, band) - 1
+        if index < 0:
+            return None
+        _, last, key, size = self.packages[index]
+        if band > last:
+            return None
+        return key, size
+
+    def _index(self, key, size):
+        with self._lock:
+            if key in self._indexes:
+                return self._indexes[key]
+
+        self.logger.info("Indexing package %s", key)
+        members = Unarchiver(RangedFile(self.backend, key, size)).members()
+        index = {
+            name: (offset, length, flags) for name, offset, length, flags in members
+        }
+
+        with self._lock:
+            self._indexes[key] = index
+        return index
+
+    def _fetch(self, band):
+        package = self._package_for(band)
+        if package is None:
+            return None
+
+        name = format(band, "x")
+        member = self._index(*package).get(name)
+        if member is None:
+            return None
+
+        # Every fetch gets its own file, as prefetches run concurrently.
+        offset, length, flags = member
+        self.logger.debug("Fetching band %s from %s", name, package[0])
+        wrapper = FileWrapper(
+            RangedFile(self.backend, package[0], package[1]),
+            offset,
+            length,
+            flags,
+            name,
+            MemberCipher.for_flags(flags, self.key),
+        )
+        return wrapper.read(self.band_size)
+
+    def _load(self, band):
+        """Fetches a band unless it is cached or already being fetched, and
+        caches it."""
+        with self._lock:
+            if band in self._bands:
+                self._bands.move_to_end(band)
+                return self._bands[band]
+
+            future = self._pending.get(band)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._pending[band] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            content = self._fetch(band)
+        except Exception as ex:
+            with self._lock:
+                del self._pending[band]
+            future.set_exception(ex)
+            raise
+
+        with self._lock:
+            del self._pending[band]
+            self._bands[band] = content
+            while len(self._bands) > self.cache_bands:
+                self._bands.popitem(last=False)
+        future.set_result(content)
+        return content
+
+    def _prefetch_after(self, band):
+        last_band = (self.size - 1) // self.band_size
+        for ahead in range(band + 1, min(band + self.prefetch, last_band) + 1):
+            with self._lock:
+                if ahead in self._bands or ahead in self._pending:
+                    continue
+            self._pool.submit(self._load, ahead)
+
+    def _band(self, band):
+        sequential = self._last_band is not None and band == self._last_band + 1
+        self._last_band = band
+        if sequential and self._pool is not None:
+            self._prefetch_after(band)
+        return self._load(band)
+
+    def read(self, offset, length):
+        """Returns `length` bytes of the image starting at `offset`, or fewer at
+        the end of the image."""
+        length = max(0, min(length, self.size - offset))
+
+        chunks = []
+        while length > 0:
+            band, within = divmod(offset, self.band_size)
+            to_read = min(length, self.band_size - within)
+
+            content = self._band(band)
+            chunk = b"" if content is None else content[within : within + to_read]
+            chunks.append(chunk + b"\x00" * (to_read - len(chunk)))
+
+            offset += to_read
+            length -= to_read
+
+        return b"".join(chunks)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+# Fixed newstyle handshake of the NBD protocol.
+NBD_MAGIC = b"NBDMAGIC"
+NBD_OPTS_MAGIC = 0x49484156454F5054
+NBD_REP_MAGIC = 0x3E889045565A9
+NBD_FLAG_FIXED_NEWSTYLE = 0x1
+NBD_FLAG_NO_ZEROES = 0x2
+NBD_FLAG_C_NO_ZEROES = 0x2
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = 0x80000001
+NBD_INFO_EXPORT = 0
+NBD_FLAG_HAS_FLAGS = 0x1
+NBD_FLAG_READ_ONLY = 0x2
+
+_NBD_OPTION = struct.Struct(">QLL")
+_NBD_OPTION_REPLY = struct.Struct(">QLLL")
+
+# Transmission phase of the NBD protocol, with simple replies.
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_EPERM = 1
+NBD_EINVAL = 22
+
+_NBD_REQUEST = struct.Struct(">LHHQQL")
+_NBD_REPLY = struct.Struct(">LLQ")
+
+
+def _reply_option(outfile, option, reply, data=b""):
+    outfile.write(
+        _NBD_OPTION_REPLY.pack(NBD_REP_MAGIC, option, reply, len(data)) + data
+    )
+    outfile.flush()
+
+
+def negotiate(image, infile, outfile):
+    """Runs the server side of the fixed newstyle NBD handshake, offering
+    `image` as a read-only export under any name. Returns whether the client
+    went on to the transmission phase."""
+    outfile.write(
+        NBD_MAGIC
+        + struct.pack(
+            ">QH", NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES
+        )
+    )
+    outfile.flush()
+
+    client_flags = _read_exactly(infile, 4)
+    if len(client_flags) < 4:
+        return False
+    no_zeroes = struct.unpack(">L", client_flags)[0] & NBD_FLAG_C_NO_ZEROES != 0
+
+    export = struct.pack(">QH", image.size, NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY)
+    while True:
+        header = _read_exactly(infile, _NBD_OPTION.size)
+        if len(header) < _NBD_OPTION.size:
+            return False
+
+        magic, option, length = _NBD_OPTION.unpack(header)
+        if magic != NBD_OPTS_MAGIC:
+            raise RuntimeError("Invalid NBD option magic: {:#x}".format(magic))
+        _read_exactly(infile, length)
+
+        if option == NBD_OPT_EXPORT_NAME:
+            outfile.write(export + (b"" if no_zeroes else b"\x00" * 124))
+            outfile.flush()
+            return True
+        elif option == NBD_OPT_ABORT:
+            _reply_option(outfile, option, NBD_REP_ACK)
+            return False
+        elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+            _reply_option(
+                outfile,
+                option,
+                NBD_REP_INFO,
+                struct.pack(">H", NBD_INFO_EXPORT) + export,
+            )
+            _reply_option(outfile, option, NBD_REP_ACK)
+            if option == NBD_OPT_GO:
+                return True
+        else:
+            _reply_option(outfile, option, NBD_REP_ERR_UNSUP)
+
+
+def serve(image, infile, outfile):
+    """Serves `image` over the NBD protocol, reading from `infile` and
+    writing to `outfile`: the fixed newstyle handshake, then transmission
+    until a disconnect request or the end of `infile`."""
+    if negotiate(image, infile, outfile):
+        transmit(image, infile, outfile)
+
+
+def transmit(image, infile, outfile):
+    """Serves `image` over the transmission phase of the NBD protocol, reading
+    requests from `infile` and writing replies to `outfile`, until a
+    disconnect request or the end of `infile`. The image is read-only, so
+    writes fail with EPERM."""
+    while True:
+        request = _read_exactly(infile, _NBD_REQUEST.size)
+        if len(request) < _NBD_REQUEST.size:
+            return
+
+        magic, _, command, handle, offset, length = _NBD_REQUEST.unpack(request)
+        if magic != NBD_REQUEST_MAGIC:
+            raise RuntimeError("Invalid NBD request magic: {:#x}".format(magic))
+
+        if command == NBD_CMD_DISC:
+            return
+        elif command == NBD_CMD_READ:
+            if offset + length > image.size:
+                outfile.write(_NBD_REPLY.pack(NBD_REPLY_MAGIC, NBD_EINVAL, handle))
+            else:
+                data = image.read(offset, length)
+                outfile.write(_NBD_REPLY.pack(NBD_REPLY_MAGIC, 0, handle) + data)
+        else:
+            if command == NBD_CMD_WRITE:
+                _read_exactly(infile, length)
+                error = NBD_EPERM
+            else:
+                error = NBD_EINVAL
+            outfile.write(_NBD_REPLY.pack(NBD_REPLY_MAGIC, error, handle))
+
+        outfile.flush()
@@ -0,0 +1,56 @@
+import os
+import json
+import urllib.parse
+
+
+class UploadJournal:
+    """Durable record of in-progress multipart uploads.
+
+    Each upload is kept in its own JSON file under `directory`, named after
+    the quoted remote key. An entry holds the upload ID, the size and part
+    size of the content, a fingerprint and MD5 identifying that content, and
+    the part numbers, ETags and content offsets of every completed part.
+    Entries are rewritten atomically after every part so that a crash loses
+    at most the part in flight."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, remote):
+        return os.path.join(
+            self.directory, urllib.parse.quote(remote, safe="") + ".json"
+        )
+
+    def load(self, remote):
+        try:
+            with open(self._path(remote), "rb") as file:
+                return json.loads(file.read().decode())
+        except FileNotFoundError:
+            return None
+
+    def save(self, remote, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(remote)
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "wb") as file:
+            file.write(json.dumps(entry, sort_keys=True).encode())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def remove(self, remote):
+        try:
+            os.remove(self._path(remote))
+        except FileNotFoundError:
+            pass
+
+    def remotes(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(
+            urllib.parse.unquote(filename[: -len(".json")])
+            for filename in os.listdir(self.directory)
+            if filename.endswith(".json")
+        )
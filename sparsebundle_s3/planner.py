@@ -0,0 +1,195 @@
+import logging
+import os
+import hashlib
+import functools
+import time
+
+from arc.common import MAGIC, HEADER_LEN
+
+CODECS = ["none", "gzip", "lz4"]
+
+# Archive header, and the name field of a member, both stored outside its
+# content.
+ARCHIVE_HEADER_LEN = len(MAGIC) + HEADER_LEN
+MEMBER_NAME_LEN_LEN = 4
+
+
+def _sample(bands, fraction):
+    """Picks an evenly spaced subset of `bands` covering roughly `fraction`
+    of them, always keeping at least one band."""
+    count = max(1, int(round(len(bands) * fraction)))
+    count = min(count, len(bands))
+    return [bands[i * len(bands) // count] for i in range(count)]
+
+
+class CodecEstimate:
+    def __init__(self):
+        self.sampled_raw = 0
+        self.sampled_compressed = 0
+        self.sampled_seconds = 0.0
+
+    def add_sample(self, raw, compressed, seconds):
+        self.sampled_raw += raw
+        self.sampled_compressed += compressed
+        self.sampled_seconds += seconds
+
+    def ratio(self):
+        if self.sampled_raw == 0:
+            return 1.0
+        return self.sampled_compressed / self.sampled_raw
+
+    def seconds_per_byte(self):
+        if self.sampled_raw == 0:
+            return 0.0
+        return self.sampled_seconds / self.sampled_raw
+
+
+class Planner:
+    """Predicts the cost of an upload without compressing or hashing whole
+    packages.
+
+    A fraction of the bands in each package is archived with every codec,
+    with the uploader's encryption and framing, to estimate its compression
+    ratio and speed. Packages are compared
+    against the remote listing by modification time: a package is considered
+    up to date if its object exists and is newer than all of its bands."""
+
+    def __init__(self, uploader, sample_fraction, bandwidth, jobs):
+        self.uploader = uploader
+        self.sample_fraction = sample_fraction
+        self.bandwidth = bandwidth
+        self.jobs = jobs
+
+        self.logger = logging.getLogger("planner")
+
+    def _list_remote(self):
+        prefix = "{}/bands/".format(self.uploader.name)
+        return {
+            info.key: info.last_modified for info in self.uploader.backend.list(prefix)
+        }
+
+    def _single_pass(self):
+        """Whether members are compressed only once per upload: chunked
+        archives are compressed as they are streamed, and a budgeted cache is
+        assumed to be large enough to hold a package."""
+        return (
+            self.uploader.chunked
+            or self.uploader.cache_chunks
+            or self.uploader.cache is not None
+        )
+
+    def _measure(self, band, estimates, md5_estimate):
+        """Archives `band` on its own with every codec, with the uploader's
+        encryption and framing, and records the size of its member."""
+        name = format(band, "x")
+        overhead = ARCHIVE_HEADER_LEN + MEMBER_NAME_LEN_LEN + len(name)
+
+        with open(self.uploader.band_path(band), "rb") as band_file:
+            raw = os.fstat(band_file.fileno()).st_size
+
+            for codec in CODECS:
+                archive = self.uploader.new_archiver(codec == "gzip", codec == "lz4")
+                try:
+                    # Process time counts every thread, including the block
+                    # compression pool of split members.
+                    start = time.process_time()
+                    archive.add_file(name, band_file)
+                    read = functools.partial(archive.read, 1024 * 1024)
+                    archived = b"".join(iter(read, b""))
+                    elapsed = time.process_time() - start
+                finally:
+                    archive.release()
+
+                # Uncached members are compressed once for their length and
+                # once more when read.
+                elapsed /= 1 if self._single_pass() else 2
+                estimates[codec].add_sample(raw, len(archived) - overhead, elapsed)
+
+            start = time.process_time()
+            hashlib.md5(archived).digest()
+            md5_estimate.add_sample(
+                len(archived), len(archived), time.process_time() - start
+            )
+
+    def plan(self):
+        """Logs the estimated cost of uploading with every codec, and returns
+        the number of packages to upload and the estimated bytes to upload
+        by codec."""
+        bands = self.uploader.find_bands()
+        packages = self.uploader.package_manifests(bands)
+        self.logger.info(
+            "Found %d bands in %d packages -- sampling %.1f%% of bands",
+            len(bands),
+            len(packages),
+            self.sample_fraction * 100,
+        )
+
+        remote = self._list_remote()
+        estimates = {codec: CodecEstimate() for codec in CODECS}
+        md5_estimate = CodecEstimate()
+
+        dirty_packages = 0
+        dirty_raw = 0
+        dirty_overhead = 0
+        dirty_members = 0
+
+        for package_id in sorted(packages.keys()):
+            package_bands = packages[package_id]
+            mtime = 0.0
+            raw = 0
+            overhead = ARCHIVE_HEADER_LEN
+
+            for band in package_bands:
+                stat = os.stat(self.uploader.band_path(band))
+                mtime = max(mtime, stat.st_mtime)
+                raw += stat.st_size
+                overhead += MEMBER_NAME_LEN_LEN + len(format(band, "x"))
+
+            remote_path = self.uploader.package_remote_path(package_id)
+            if remote_path in remote and remote[remote_path] >= mtime:
+                continue
+
+            dirty_packages += 1
+            dirty_raw += raw
+            dirty_overhead += overhead
+            dirty_members += len(package_bands)
+
+            for band in _sample(package_bands, self.sample_fraction):
+                self._measure(band, estimates, md5_estimate)
+
+        self.logger.info(
+            "%d of %d packages need uploading (%d bands, %.1f MiB uncompressed)",
+            dirty_packages,
+            len(packages),
+            dirty_members,
+            dirty_raw / 1024 / 1024,
+        )
+
+        # Unless it is compressed in a single pass, every member is compressed
+        # once for its length, once for the MD5 pass and once more for the
+        # upload.
+        passes = 1 if self._single_pass() else 3
+
+        upload = {}
+        for codec in CODECS:
+            estimate = estimates[codec]
+            upload_bytes = dirty_raw * estimate.ratio() + dirty_overhead
+            upload[codec] = upload_bytes
+            cpu = dirty_raw * estimate.seconds_per_byte() * passes
+            cpu += upload_bytes * md5_estimate.seconds_per_byte()
+            transfer = upload_bytes / (self.bandwidth * 1024 * 1024)
+
+            self.logger.info(
+                "  %-4s  ratio %.3f  upload %.1f MiB  CPU %.1fs  "
+                "transfer %.1fs  wall-clock %.1fs (serial) / %.1fs (%d jobs)",
+                codec,
+                estimate.ratio(),
+                upload_bytes / 1024 / 1024,
+                cpu,
+                transfer,
+                cpu + transfer,
+                max(cpu / self.jobs, transfer),
+                self.jobs,
+            )
+
+        return {"dirty_packages": dirty_packages, "upload_bytes": upload}
@@ -0,0 +1,428 @@
+import collections
+import os
+import hashlib
+import base64
+import functools
+import json
+import shutil
+import uuid
+import urllib.parse
+
+import boto3
+import botocore
+
+ObjectInfo = collections.namedtuple(
+    "ObjectInfo", ["key", "size", "etag", "last_modified"]
+)
+
+# Names of the bookkeeping directories kept under a LocalBackend's root.
+LOCAL_META_DIR = ".meta"
+LOCAL_MULTIPART_DIR = ".multipart"
+
+
+def multipart_etag(part_digests):
+    """Computes the ETag S3 assigns to a multipart object from the binary MD5
+    digests of its parts."""
+    md5 = hashlib.md5()
+    for digest in part_digests:
+        md5.update(digest)
+    return "{}-{}".format(md5.hexdigest(), len(part_digests))
+
+
+def open_backend(url, client=None):
+    """Returns a `(backend, name)` tuple for a destination URL.
+
+    `s3://bucket/name` stores objects under the prefix `name` of an S3
+    bucket, through `client` if one is given. `file:///path/name` stores
+    them under the directory `/path`, again prefixed by `name`."""
+    parsed = urllib.parse.urlparse(url)
+    path = parsed.path.strip("/")
+
+    if parsed.scheme == "s3":
+        if not parsed.netloc or not path:
+            raise RuntimeError("Invalid S3 URL: {}".format(url))
+        return S3Backend(parsed.netloc, client), path
+    elif parsed.scheme == "file":
+        if parsed.netloc or not path:
+            raise RuntimeError("Invalid file URL: {}".format(url))
+        root, name = os.path.split("/" + path)
+        return LocalBackend(root), name
+    else:
+        raise RuntimeError("Unsupported destination URL: {}".format(url))
+
+
+class StorageBackend:
+    """Interface of an object store that packages are uploaded into.
+
+    Keys are `/`-separated strings. ETags are returned without quotes and
+    follow S3's conventions: the hex MD5 of the content for single-part
+    objects, and `multipart_etag()` of the parts for multipart objects."""
+
+    def put(self, key, body, md5, storage_class):
+        """Stores the content of the file-like `body` under `key`. `md5` is a
+        hashlib MD5 object of the content and is verified by the store."""
+        raise NotImplementedError()
+
+    def stat(self, key):
+        """Returns an `ObjectInfo` for `key`, or None if it does not exist."""
+        raise NotImplementedError()
+
+    def list(self, prefix):
+        """Yields an `ObjectInfo` for every object whose key starts with
+        `prefix`."""
+        raise NotImplementedError()
+
+    def get_range(self, key, start, length=None):
+        """Returns `length` bytes of the object starting at `start`, or
+        everything after `start` if `length` is None."""
+        raise NotImplementedError()
+
+    def open(self, key):
+        """Returns a forward-only file-like object streaming the object's
+        content."""
+        raise NotImplementedError()
+
+    def create_multipart(self, key, storage_class):
+        """Starts a multipart upload and returns its upload ID."""
+        raise NotImplementedError()
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """Uploads the bytes `data` as part `part_number` (starting from 1)
+        and returns the part's ETag."""
+        raise NotImplementedError()
+
+    def complete_multipart(self, key, upload_id, parts):
+        """Assembles the object from `parts`, a list of `(part_number, etag)`
+        tuples in ascending order."""
+        raise NotImplementedError()
+
+    def abort_multipart(self, key, upload_id):
+        raise NotImplementedError()
+
+    def list_multipart(self, prefix):
+        """Yields `(key, upload_id)` for in-progress multipart uploads whose
+        key starts with `prefix`."""
+        raise NotImplementedError()
+
+
+class S3Backend(StorageBackend):
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self.client = client if client is not None else boto3.client("s3")
+
+    def put(self, key, body, md5, storage_class):
+        try:
+            body.seek(0)
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=body,
+                StorageClass=storage_class,
+                ContentMD5=base64.b64encode(md5.digest()).decode(),
+            )
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while uploading to S3: {}".format(ex))
+
+    def stat(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError:
+            return None
+
+        return ObjectInfo(
+            key,
+            response["ContentLength"],
+            response["ETag"][1:-1],
+            response["LastModified"].timestamp(),
+        )
+
+    def list(self, prefix):
+        try:
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    yield ObjectInfo(
+                        obj["Key"],
+                        obj["Size"],
+                        obj["ETag"][1:-1],
+                        obj["LastModified"].timestamp(),
+                    )
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while listing S3: {}".format(ex))
+
+    def get_range(self, key, start, length=None):
+        if length is None:
+            byte_range = "bytes={}-".format(start)
+        elif length == 0:
+            return b""
+        else:
+            byte_range = "bytes={}-{}".format(start, start + length - 1)
+
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=key, Range=byte_range
+            )
+            return response["Body"].read()
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while reading from S3: {}".format(ex))
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while reading from S3: {}".format(ex))
+
+    def create_multipart(self, key, storage_class):
+        try:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=key, StorageClass=storage_class
+            )
+            return response["UploadId"]
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while uploading to S3: {}".format(ex))
+
+    def upload_part(self, key, upload_id, part_number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+                ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode(),
+            )
+            return response["ETag"][1:-1]
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while uploading to S3: {}".format(ex))
+
+    def complete_multipart(self, key, upload_id, parts):
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": number, "ETag": '"{}"'.format(etag)}
+                        for number, etag in parts
+                    ]
+                },
+            )
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while uploading to S3: {}".format(ex))
+
+    def abort_multipart(self, key, upload_id):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while aborting S3 upload: {}".format(ex))
+
+    def list_multipart(self, prefix):
+        try:
+            paginator = self.client.get_paginator("list_multipart_uploads")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for upload in page.get("Uploads", []):
+                    yield (upload["Key"], upload["UploadId"])
+        except botocore.exceptions.ClientError as ex:
+            raise RuntimeError("Exception while listing S3 uploads: {}".format(ex))
+
+
+class LocalBackend(StorageBackend):
+    """Stores objects as plain files under a root directory.
+
+    Objects are written to a temporary file and moved into place with
+    `os.replace`, so readers never see partial content. ETags are kept in
+    sidecar JSON files under `<root>/.meta/`, together with the size and
+    mtime of the object they describe so that stale sidecars are ignored.
+    Multipart uploads are staged under `<root>/.multipart/<upload_id>/`."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _meta_path(self, key):
+        return os.path.join(self.root, LOCAL_META_DIR, *key.split("/")) + ".json"
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.root, LOCAL_MULTIPART_DIR, upload_id)
+
+    @staticmethod
+    def _write_atomic(path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(path, uuid.uuid4().hex)
+
+        try:
+            with open(tmp_path, "wb") as file:
+                result = write(file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return result
+
+    def _commit(self, key, write):
+        """Writes an object through `write(file)`, which returns its ETag."""
+        path = self._path(key)
+        etag = self._write_atomic(path, write)
+
+        stat = os.stat(path)
+        meta = {"etag": etag, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        self._write_atomic(
+            self._meta_path(key), lambda file: file.write(json.dumps(meta).encode())
+        )
+
+    def put(self, key, body, md5, storage_class):
+        def write(file):
+            actual = hashlib.md5()
+            body.seek(0)
+            for chunk in iter(lambda: body.read(1024 * 1024), b""):
+                actual.update(chunk)
+                file.write(chunk)
+
+            if actual.digest() != md5.digest():
+                raise RuntimeError("Checksum mismatch while writing {}".format(key))
+
+            return actual.hexdigest()
+
+        self._commit(key, write)
+
+    def stat(self, key):
+        path = self._path(key)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        etag = None
+        try:
+            with open(self._meta_path(key), "rb") as file:
+                meta = json.loads(file.read().decode())
+            if meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime_ns:
+                etag = meta["etag"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        if etag is None:
+            md5 = hashlib.md5()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                    md5.update(chunk)
+            etag = md5.hexdigest()
+
+        return ObjectInfo(key, stat.st_size, etag, stat.st_mtime)
+
+    def list(self, prefix):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [
+                    d
+                    for d in dirnames
+                    if d not in (LOCAL_META_DIR, LOCAL_MULTIPART_DIR)
+                ]
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                if ".tmp-" in filename:
+                    continue
+
+                relpath = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                key = "/".join(relpath.split(os.sep))
+                if key.startswith(prefix):
+                    info = self.stat(key)
+                    if info is not None:
+                        yield info
+
+    def get_range(self, key, start, length=None):
+        try:
+            with open(self._path(key), "rb") as file:
+                file.seek(start)
+                return file.read() if length is None else file.read(length)
+        except FileNotFoundError:
+            raise RuntimeError("Object does not exist: {}".format(key))
+
+    def open(self, key):
+        try:
+            return open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise RuntimeError("Object does not exist: {}".format(key))
+
+    def create_multipart(self, key, storage_class):
+        upload_id = uuid.uuid4().hex
+        upload_dir = self._upload_dir(upload_id)
+        os.makedirs(upload_dir)
+        self._write_atomic(
+            os.path.join(upload_dir, "key"), lambda file: file.write(key.encode())
+        )
+        return upload_id
+
+    def _check_upload(self, key, upload_id):
+        try:
+            with open(os.path.join(self._upload_dir(upload_id), "key"), "rb") as file:
+                if file.read().decode() == key:
+                    return
+        except FileNotFoundError:
+            pass
+
+        raise RuntimeError("No such upload {} for {}".format(upload_id, key))
+
+    def upload_part(self, key, upload_id, part_number, data):
+        self._check_upload(key, upload_id)
+        self._write_atomic(
+            os.path.join(self._upload_dir(upload_id), "part-{}".format(part_number)),
+            lambda file: file.write(data),
+        )
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, key, upload_id, parts):
+        self._check_upload(key, upload_id)
+        upload_dir = self._upload_dir(upload_id)
+
+        def write(file):
+            digests = []
+            for number, etag in parts:
+                md5 = hashlib.md5()
+                part_path = os.path.join(upload_dir, "part-{}".format(number))
+                with open(part_path, "rb") as part:
+                    read = functools.partial(part.read, 1024 * 1024)
+                    for chunk in iter(read, b""):
+                        md5.update(chunk)
+                        file.write(chunk)
+
+                if md5.hexdigest() != etag:
+                    raise RuntimeError(
+                        "ETag mismatch for part {} of {}".format(number, key)
+                    )
+                digests.append(md5.digest())
+
+            return multipart_etag(digests)
+
+        self._commit(key, write)
+        shutil.rmtree(upload_dir)
+
+    def abort_multipart(self, key, upload_id):
+        self._check_upload(key, upload_id)
+        shutil.rmtree(self._upload_dir(upload_id))
+
+    def list_multipart(self, prefix):
+        multipart_dir = os.path.join(self.root, LOCAL_MULTIPART_DIR)
+        if not os.path.isdir(multipart_dir):
+            return
+
+        for upload_id in sorted(os.listdir(multipart_dir)):
+            try:
+                with open(os.path.join(multipart_dir, upload_id, "key"), "rb") as file:
+                    key = file.read().decode()
+            except FileNotFoundError:
+                continue
+
+            if key.startswith(prefix):
+                yield (key, upload_id)
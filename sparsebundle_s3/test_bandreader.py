@@ -0,0 +1,119 @@
+import unittest
+import os
+import tempfile
+import time
+
+from sparsebundle_s3.bandreader import DIRECT_ALIGNMENT, BandFile, BandReader
+
+
+class TestBandReader(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        self.contents = []
+        for band in range(6):
+            path = os.path.join(self.tempdir.name, format(band, "x"))
+            content = os.urandom(3 * DIRECT_ALIGNMENT + 123 * band)
+            with open(path, "wb") as file:
+                file.write(content)
+            self.paths.append(path)
+            self.contents.append(content)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _check_reads(self, direct):
+        content = self.contents[5]
+        with BandFile(self.paths[5], drop_cache=True, direct=direct) as file:
+            self.assertEqual(file.name, self.paths[5])
+            self.assertEqual(file.read(), content)
+            self.assertEqual(file.read(10), b"")
+
+            file.seek(DIRECT_ALIGNMENT - 7)
+            self.assertEqual(file.read(20), content[DIRECT_ALIGNMENT - 7 :][:20])
+            self.assertEqual(file.tell(), DIRECT_ALIGNMENT + 13)
+
+            file.seek(0)
+            chunks = list(iter(lambda: file.read(1000), b""))
+            self.assertEqual(b"".join(chunks), content)
+
+    def test_buffered_reads(self):
+        self._check_reads(False)
+
+    def test_direct_reads(self):
+        if not hasattr(os, "O_DIRECT"):
+            self.skipTest("O_DIRECT is not supported")
+        # Falls back to buffered reads where the filesystem refuses O_DIRECT.
+        self._check_reads(True)
+
+    @unittest.skipUnless(
+        hasattr(os, "POSIX_FADV_WILLNEED"), "posix_fadvise is not supported"
+    )
+    def test_prefetch_stays_within_readahead(self):
+        reader = BandReader(readahead=2 * len(self.contents[0]))
+        reader.schedule(self.paths)
+        try:
+            for path, content in zip(self.paths, self.contents):
+                deadline = time.time() + 5
+                while time.time() < deadline:
+                    with reader._cond:
+                        if reader._ahead >= reader.readahead or reader._next == len(
+                            self.paths
+                        ):
+                            break
+                    time.sleep(0.01)
+
+                with reader._cond:
+                    self.assertLessEqual(reader._next - reader._consumed, 2)
+
+                with reader.open(path) as file:
+                    self.assertEqual(file.read(), content)
+
+            with reader._cond:
+                self.assertEqual(reader._consumed, len(self.paths))
+                self.assertEqual(reader._ahead, 0)
+                self.assertEqual(reader._order, [])
+                self.assertEqual(reader._positions, {})
+        finally:
+            reader.close()
+
+    def test_schedule_after_consuming(self):
+        reader = BandReader(readahead=2 * len(self.contents[0]))
+        try:
+            # A watching process schedules each flush once the previous one
+            # has been read.
+            for start in (0, 3):
+                reader.schedule(self.paths[start : start + 3])
+                for path, content in zip(
+                    self.paths[start : start + 3], self.contents[start : start + 3]
+                ):
+                    with reader.open(path) as file:
+                        self.assertEqual(file.read(), content)
+
+                with reader._cond:
+                    self.assertEqual(reader._consumed, start + 3)
+                    self.assertEqual(reader._order, [])
+                    self.assertEqual(reader._positions, {})
+        finally:
+            reader.close()
+
+    def test_direct_reads_share_buffers(self):
+        if not hasattr(os, "O_DIRECT"):
+            self.skipTest("O_DIRECT is not supported")
+
+        reader = BandReader(direct_io=True)
+        files = [reader.open(path) for path in self.paths]
+        try:
+            for file, content in zip(files, self.contents):
+                self.assertEqual(file.read(), content)
+
+            # Open files hold no buffer between reads.
+            self.assertLessEqual(len(reader.buffers._free), 1)
+        finally:
+            for file in files:
+                file.close()
+            reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
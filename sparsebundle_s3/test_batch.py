@@ -0,0 +1,147 @@
+import unittest
+import concurrent.futures
+import json
+import os
+import tempfile
+
+from sparsebundle_s3.batch import BatchRunner, load_config
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _make_bundle(self, name, band_count):
+        bundle = os.path.join(self.tempdir.name, name + ".sparsebundle")
+        os.makedirs(os.path.join(bundle, "bands"))
+
+        with open(os.path.join(bundle, "Info.plist"), "wb") as file:
+            file.write(b"plist")
+
+        for band in range(band_count):
+            with open(os.path.join(bundle, "bands", format(band, "x")), "wb") as file:
+                file.write(bytes([band]) * 100)
+
+        return bundle
+
+    def _write_config(self, config):
+        path = os.path.join(self.tempdir.name, "config.json")
+        with open(path, "w") as file:
+            json.dump(config, file)
+        return path
+
+    def test_load_config_defaults(self):
+        path = self._write_config(
+            {
+                "lz4": True,
+                "bundles": [
+                    {"bundle": "a", "tmpdir": "ta", "destination": "file:///a/a"},
+                    {
+                        "bundle": "b",
+                        "tmpdir": "tb",
+                        "destination": "file:///b/b",
+                        "lz4": False,
+                        "package_size": 16,
+                    },
+                ],
+            }
+        )
+
+        entries = load_config(path)
+        self.assertTrue(entries[0]["lz4"])
+        self.assertEqual(entries[0]["package_size"], 0x100)
+        self.assertFalse(entries[1]["lz4"])
+        self.assertEqual(entries[1]["package_size"], 16)
+
+    def test_load_config_unknown_option(self):
+        path = self._write_config(
+            {
+                "bundles": [
+                    {"bundle": "a", "tmpdir": "t", "destination": "d", "gzp": True}
+                ]
+            }
+        )
+
+        with self.assertRaises(RuntimeError):
+            load_config(path)
+
+    def test_shared_block_pool(self):
+        dest = os.path.join(self.tempdir.name, "dest")
+        entries = load_config(
+            self._write_config(
+                {
+                    "block_size": 64,
+                    "bundles": [
+                        {
+                            "bundle": self._make_bundle(name, 1),
+                            "tmpdir": os.path.join(self.tempdir.name, "tmp-" + name),
+                            "destination": "file://{}/{}".format(dest, name),
+                        }
+                        for name in ["a", "b"]
+                    ],
+                }
+            )
+        )
+
+        runner = BatchRunner(entries, 1, True, None)
+        self.assertEqual(runner.block_jobs, os.cpu_count() or 1)
+
+        with concurrent.futures.ThreadPoolExecutor(2) as block_pool:
+            uploaders = [
+                runner._make_uploader(entry, None, block_pool) for entry in entries
+            ]
+            self.assertEqual(uploaders[1].block_size, 64 * 1024)
+
+            # Every package of every bundle compresses its blocks on the
+            # shared pool, which outlives each archive.
+            for uploader in uploaders:
+                archive = uploader.new_archiver()
+                self.assertIs(archive.executor, block_pool)
+                archive.release()
+            self.assertEqual(block_pool.submit(len, b"ok").result(), 2)
+
+    def test_run(self):
+        dest = os.path.join(self.tempdir.name, "dest")
+        entries = load_config(
+            self._write_config(
+                {
+                    "package_size": 4,
+                    "block_size": 1,
+                    "bundles": [
+                        {
+                            "bundle": self._make_bundle(name, count),
+                            "tmpdir": os.path.join(self.tempdir.name, "tmp-" + name),
+                            "destination": "file://{}/{}".format(dest, name),
+                        }
+                        for name, count in [("a", 10), ("b", 3)]
+                    ]
+                    + [
+                        {
+                            "bundle": os.path.join(self.tempdir.name, "missing"),
+                            "tmpdir": os.path.join(self.tempdir.name, "tmp-c"),
+                            "destination": "file://{}/c".format(dest),
+                        }
+                    ],
+                }
+            )
+        )
+
+        summaries = BatchRunner(entries, 3, True, None, 2).run()
+
+        self.assertEqual([s.packages for s in summaries], [3, 1, 0])
+        self.assertEqual([s.failed for s in summaries], [0, 0, 0])
+        self.assertIsNone(summaries[0].error)
+        self.assertIsNotNone(summaries[2].error)
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(dest, "a", "bands"))),
+            ["0-3.arc", "4-7.arc", "8-b.arc"],
+        )
+        self.assertEqual(os.listdir(os.path.join(dest, "b", "bands")), ["0-3.arc"])
+
+
+if __name__ == "__main__":
+    unittest.main()
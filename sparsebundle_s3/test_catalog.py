@@ -0,0 +1,131 @@
+import unittest
+import io
+import os
+import tempfile
+
+from sparsebundle_s3.catalog import (
+    Catalog,
+    CatalogEntry,
+    Segment,
+    COMPACT_THRESHOLD,
+)
+
+
+class TestSegment(unittest.TestCase):
+    def test_lookup(self):
+        entries = [
+            CatalogEntry(
+                "name/bands/{:x}.arc".format(i), "{:032x}".format(i), i, 2 * i, 1
+            )
+            for i in range(100)
+        ]
+        segment = Segment(Segment.encode(1, reversed(entries)))
+
+        self.assertEqual(segment.generation, 1)
+        self.assertEqual(segment.count, 100)
+        for entry in entries:
+            self.assertEqual(segment.lookup(entry.name), entry)
+        self.assertIsNone(segment.lookup("name/bands/missing.arc"))
+        self.assertEqual(list(segment.entries()), sorted(entries))
+
+    def test_empty(self):
+        segment = Segment(Segment.encode(3, []))
+
+        self.assertIsNone(segment.lookup("test"))
+        self.assertEqual(list(segment.entries()), [])
+
+    def test_invalid_magic(self):
+        with self.assertRaises(RuntimeError):
+            Segment(b"\x00" * 16)
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_generations(self):
+        catalog = Catalog(self.tempdir.name)
+        catalog.add("test", "aaaa", 11, 11)
+        catalog.add("wow", "bbbb", 14, 28)
+        self.assertEqual(catalog.generation, 1)
+
+        catalog = Catalog(self.tempdir.name)
+        self.assertEqual(catalog.generation, 2)
+        self.assertEqual(catalog.lookup("wow"), CatalogEntry("wow", "bbbb", 14, 28, 1))
+        self.assertIsNone(catalog.segment_path())
+
+        catalog.add("test", "cccc", 12, 12)
+        self.assertEqual(
+            os.path.basename(catalog.segment_path()), "segment-00000002.cat"
+        )
+
+        catalog = Catalog(self.tempdir.name)
+        self.assertEqual(catalog.lookup("test").md5, "cccc")
+        self.assertEqual(catalog.lookup("test").generation, 2)
+        self.assertEqual([e.name for e in catalog.entries()], ["test", "wow"])
+
+    def test_log_replay(self):
+        catalog = Catalog(self.tempdir.name)
+        catalog.add("test", "aaaa", 11, 11)
+        catalog.flush()
+        catalog.add("test", "bbbb", 12, 12)
+        catalog.add("wow", "cccc", 14, 28)
+        self.assertEqual(
+            sorted(os.listdir(self.tempdir.name)),
+            ["segment-00000001.cat", "segment-00000001.log"],
+        )
+
+        # Tears the last record, as an interrupted append would.
+        log_path = os.path.join(self.tempdir.name, "segment-00000001.log")
+        with open(log_path, "r+b") as file:
+            file.truncate(os.path.getsize(log_path) - 3)
+
+        catalog = Catalog(self.tempdir.name)
+        self.assertEqual(os.listdir(self.tempdir.name), ["segment-00000001.cat"])
+        self.assertEqual(catalog.generation, 2)
+        self.assertEqual(catalog.lookup("test").md5, "bbbb")
+        self.assertIsNone(catalog.lookup("wow"))
+
+    def test_compaction(self):
+        for i in range(COMPACT_THRESHOLD + 1):
+            catalog = Catalog(self.tempdir.name)
+            catalog.add("test", "{:04x}".format(i), i, i)
+            catalog.add("only-{}".format(i % 2), "{:04x}".format(i), i, i)
+
+        entries = catalog.entries()
+        self.assertTrue(catalog.compact())
+        self.assertEqual(catalog.entries(), entries)
+        self.assertEqual(os.listdir(self.tempdir.name), ["base-00000011.cat"])
+
+        catalog = Catalog(self.tempdir.name)
+        self.assertEqual(catalog.entries(), entries)
+        self.assertEqual(catalog.lookup("test").md5, "0010")
+        self.assertEqual(catalog.generation, COMPACT_THRESHOLD + 2)
+
+    def test_no_compaction_below_threshold(self):
+        catalog = Catalog(self.tempdir.name)
+        catalog.add("test", "aaaa", 11, 11)
+
+        self.assertFalse(catalog.compact())
+        self.assertIsNone(catalog.base_path())
+
+    def test_legacy_text(self):
+        legacy_path = os.path.join(self.tempdir.name, "checksums.txt")
+        with open(legacy_path, "w") as file:
+            file.write("aaaa name/test\nbbbb name/wow\ncccc name/test\n")
+
+        catalog = Catalog(os.path.join(self.tempdir.name, "catalog"))
+        catalog.import_text(legacy_path)
+
+        self.assertEqual(catalog.lookup("name/test").md5, "cccc")
+
+        buf = io.StringIO()
+        catalog.export_text(buf)
+        self.assertEqual(buf.getvalue(), "cccc name/test\nbbbb name/wow\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
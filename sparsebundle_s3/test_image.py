@@ -0,0 +1,219 @@
+import unittest
+import io
+import os
+import plistlib
+import struct
+
+from arc.crypto import KEY_LEN
+from sparsebundle_s3.image import (
+    NBD_CMD_DISC,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_EPERM,
+    NBD_FLAG_C_NO_ZEROES,
+    NBD_FLAG_FIXED_NEWSTYLE,
+    NBD_FLAG_HAS_FLAGS,
+    NBD_FLAG_NO_ZEROES,
+    NBD_FLAG_READ_ONLY,
+    NBD_INFO_EXPORT,
+    NBD_MAGIC,
+    NBD_OPT_ABORT,
+    NBD_OPT_EXPORT_NAME,
+    NBD_OPT_GO,
+    NBD_OPTS_MAGIC,
+    NBD_REP_ACK,
+    NBD_REP_ERR_UNSUP,
+    NBD_REP_INFO,
+    NBD_REP_MAGIC,
+    NBD_REPLY_MAGIC,
+    NBD_REQUEST_MAGIC,
+    BundleImage,
+    serve,
+)
+from sparsebundle_s3.storage import LocalBackend
+from sparsebundle_s3.test_uploader import BundleFixture
+
+BAND_SIZE = 1000
+BAND_COUNT = 10
+
+SERVER_GREETING = NBD_MAGIC + struct.pack(
+    ">QH", NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES
+)
+EXPORT_FLAGS = NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY
+
+
+def nbd_option(number, data=b""):
+    return struct.pack(">QLL", NBD_OPTS_MAGIC, number, len(data)) + data
+
+
+def nbd_option_reply(number, reply, data=b""):
+    return struct.pack(">QLLL", NBD_REP_MAGIC, number, reply, len(data)) + data
+
+
+class TestBundleImage(BundleFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = LocalBackend(self.dest)
+
+        self._write_meta(
+            "Info.plist",
+            plistlib.dumps(
+                {
+                    "band-size": BAND_SIZE,
+                    "size": BAND_SIZE * BAND_COUNT - 300,
+                    "bundle-backingstore-version": 1,
+                }
+            ),
+        )
+
+        # Bands 2 and 5 to 7 are sparse, and band 3 is short.
+        self.image = bytearray(BAND_SIZE * BAND_COUNT - 300)
+        for band in [0, 1, 3, 4, 8, 9]:
+            content = os.urandom(BAND_SIZE // 2) + bytes([band]) * (BAND_SIZE // 2)
+            if band == 3:
+                content = content[:300]
+            if band == 9:
+                content = content[: BAND_SIZE - 300]
+
+            self._write_band(band, content)
+            self.image[band * BAND_SIZE : band * BAND_SIZE + len(content)] = content
+        self.image = bytes(self.image)
+
+    def _upload(self, **kwargs):
+        self._uploader(
+            self.backend, 4, lz4=True, part_size=1024 * 1024, **kwargs
+        ).upload()
+
+    def test_read(self):
+        self._upload()
+        image = BundleImage(self.backend, "test", cache_bands=2)
+        try:
+            self.assertEqual(image.size, len(self.image))
+            self.assertEqual(image.band_size, BAND_SIZE)
+            self.assertEqual(len(image.packages), 3)
+
+            for offset, length in [
+                (0, 10),
+                (990, 20),
+                (1500, 3000),
+                (0, len(self.image)),
+                (len(self.image) - 5, 100),
+                (len(self.image), 10),
+            ]:
+                self.assertEqual(
+                    image.read(offset, length),
+                    self.image[offset : offset + length],
+                    (offset, length),
+                )
+        finally:
+            image.close()
+
+    def test_read_chunked(self):
+        self._upload(chunked=True)
+        image = BundleImage(self.backend, "test")
+        try:
+            self.assertEqual(image.read(0, len(self.image)), self.image)
+            self.assertEqual(image.read(3990, 20), self.image[3990:4010])
+        finally:
+            image.close()
+
+    def test_sequential_read(self):
+        self._upload()
+        image = BundleImage(self.backend, "test", cache_bands=4, prefetch=2)
+        try:
+            chunks = []
+            for offset in range(0, len(self.image), 128):
+                chunks.append(image.read(offset, 128))
+            self.assertEqual(b"".join(chunks), self.image)
+        finally:
+            image.close()
+
+    def test_read_encrypted(self):
+        key = os.urandom(KEY_LEN)
+        self._upload(key=key)
+
+        image = BundleImage(self.backend, "test", key)
+        try:
+            self.assertEqual(image.read(0, len(self.image)), self.image)
+        finally:
+            image.close()
+
+        image = BundleImage(self.backend, "test")
+        try:
+            with self.assertRaises(RuntimeError):
+                image.read(0, 10)
+        finally:
+            image.close()
+
+    def _serve(self, client):
+        replies = io.BytesIO()
+        image = BundleImage(self.backend, "test")
+        try:
+            serve(image, io.BytesIO(client), replies)
+        finally:
+            image.close()
+        return replies.getvalue()
+
+    def test_handshake(self):
+        self._upload()
+        size = len(self.image)
+
+        # Old clients ask for an export by name and get 124 bytes of zeroes.
+        replies = self._serve(
+            struct.pack(">L", 0)
+            + nbd_option(12345)
+            + nbd_option(NBD_OPT_EXPORT_NAME, b"test")
+        )
+        self.assertEqual(
+            replies,
+            SERVER_GREETING
+            + nbd_option_reply(12345, NBD_REP_ERR_UNSUP)
+            + struct.pack(">QH", size, EXPORT_FLAGS)
+            + b"\x00" * 124,
+        )
+
+        replies = self._serve(struct.pack(">L", 0) + nbd_option(NBD_OPT_ABORT))
+        self.assertEqual(
+            replies, SERVER_GREETING + nbd_option_reply(NBD_OPT_ABORT, NBD_REP_ACK)
+        )
+
+    def test_serve(self):
+        self._upload()
+
+        def request(command, handle, offset, length, payload=b""):
+            return (
+                struct.pack(
+                    ">LHHQQL", NBD_REQUEST_MAGIC, 0, command, handle, offset, length
+                )
+                + payload
+            )
+
+        go = struct.pack(">L", 4) + b"test" + struct.pack(">H", 0)
+        replies = self._serve(
+            struct.pack(">L", NBD_FLAG_C_NO_ZEROES)
+            + nbd_option(NBD_OPT_GO, go)
+            + request(NBD_CMD_READ, 1, 1500, 100)
+            + request(NBD_CMD_WRITE, 2, 0, 4, b"abcd")
+            + request(NBD_CMD_READ, 3, 0, 10)
+            + request(NBD_CMD_DISC, 4, 0, 0)
+        )
+
+        self.assertEqual(
+            replies,
+            SERVER_GREETING
+            + nbd_option_reply(
+                NBD_OPT_GO,
+                NBD_REP_INFO,
+                struct.pack(">HQH", NBD_INFO_EXPORT, len(self.image), EXPORT_FLAGS),
+            )
+            + nbd_option_reply(NBD_OPT_GO, NBD_REP_ACK)
+            + struct.pack(">LLQ", NBD_REPLY_MAGIC, 0, 1)
+            + self.image[1500:1600]
+            + struct.pack(">LLQ", NBD_REPLY_MAGIC, NBD_EPERM, 2)
+            + struct.pack(">LLQ", NBD_REPLY_MAGIC, 0, 3)
+            + self.image[:10],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
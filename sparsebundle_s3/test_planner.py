@@ -0,0 +1,55 @@
+import unittest
+import os
+
+from arc.crypto import KEY_LEN
+from sparsebundle_s3.planner import Planner
+from sparsebundle_s3.storage import LocalBackend
+from sparsebundle_s3.test_uploader import BundleFixture
+
+
+class TestPlanner(BundleFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = LocalBackend(self.dest)
+
+        for band in range(6):
+            self._write_band(band, os.urandom(500) + bytes([band]) * 2500)
+
+    def _check_estimate(self, **kwargs):
+        kwargs.setdefault("lz4", True)
+        uploader = self._uploader(self.backend, part_size=1024 * 1024, **kwargs)
+        codec = "lz4" if kwargs["lz4"] else "none"
+
+        # With every band sampled, the estimate is exact.
+        plan = Planner(uploader, 1.0, 10, 1).plan()
+        self.assertEqual(plan["dirty_packages"], 1)
+
+        uploader.upload()
+        info = self.backend.stat(uploader.package_remote_path(0))
+        self.assertEqual(round(plan["upload_bytes"][codec]), info.size)
+
+    def test_estimate(self):
+        self._check_estimate()
+
+    def test_estimate_uncompressed(self):
+        self._check_estimate(lz4=False)
+
+    def test_estimate_encrypted(self):
+        self._check_estimate(key=os.urandom(KEY_LEN))
+
+    def test_estimate_chunked(self):
+        self._check_estimate(chunked=True)
+
+    def test_estimate_split(self):
+        self._check_estimate(block_size=1024)
+
+    def test_uploaded_packages_are_skipped(self):
+        uploader = self._uploader(self.backend, lz4=True)
+        uploader.upload()
+
+        plan = Planner(uploader, 0.5, 10, 1).plan()
+        self.assertEqual(plan["dirty_packages"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import hashlib
+import io
+import os
+import tempfile
+
+from sparsebundle_s3.storage import LocalBackend, open_backend, multipart_etag
+
+
+class TestLocalBackend(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.backend = LocalBackend(self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_put_and_stat(self):
+        content = b"testcontent"
+        self.backend.put("name/test", io.BytesIO(content), hashlib.md5(content), "")
+
+        info = self.backend.stat("name/test")
+        self.assertEqual(info.key, "name/test")
+        self.assertEqual(info.size, len(content))
+        self.assertEqual(info.etag, hashlib.md5(content).hexdigest())
+
+        with open(os.path.join(self.tempdir.name, "name", "test"), "rb") as file:
+            self.assertEqual(file.read(), content)
+
+    def test_stat_missing(self):
+        self.assertIsNone(self.backend.stat("name/missing"))
+
+    def test_put_checksum_mismatch(self):
+        with self.assertRaises(RuntimeError):
+            self.backend.put(
+                "name/test", io.BytesIO(b"testcontent"), hashlib.md5(b"wow"), ""
+            )
+
+        self.assertIsNone(self.backend.stat("name/test"))
+        self.assertEqual(os.listdir(os.path.join(self.tempdir.name, "name")), [])
+
+    def test_stale_sidecar_ignored(self):
+        self.backend.put(
+            "test", io.BytesIO(b"testcontent"), hashlib.md5(b"testcontent"), ""
+        )
+
+        with open(os.path.join(self.tempdir.name, "test"), "wb") as file:
+            file.write(b"suchgreatstuff")
+
+        info = self.backend.stat("test")
+        self.assertEqual(info.etag, hashlib.md5(b"suchgreatstuff").hexdigest())
+
+    def test_list(self):
+        for key in ["name/b", "name/a", "other/c"]:
+            self.backend.put(key, io.BytesIO(b"x"), hashlib.md5(b"x"), "")
+
+        keys = [info.key for info in self.backend.list("name/")]
+        self.assertEqual(keys, ["name/a", "name/b"])
+
+    def test_get_range(self):
+        content = b"suchgreatstuff"
+        self.backend.put("test", io.BytesIO(content), hashlib.md5(content), "")
+
+        self.assertEqual(self.backend.get_range("test", 4, 5), b"great")
+        self.assertEqual(self.backend.get_range("test", 9), b"stuff")
+
+    def test_multipart(self):
+        upload_id = self.backend.create_multipart("name/test", "")
+        self.assertEqual(
+            list(self.backend.list_multipart("name/")), [("name/test", upload_id)]
+        )
+
+        parts = []
+        for number, data in [(1, b"such"), (2, b"great"), (3, b"stuff")]:
+            parts.append(
+                (number, self.backend.upload_part("name/test", upload_id, number, data))
+            )
+        self.backend.complete_multipart("name/test", upload_id, parts)
+
+        info = self.backend.stat("name/test")
+        self.assertEqual(
+            info.etag,
+            multipart_etag(
+                [hashlib.md5(d).digest() for d in [b"such", b"great", b"stuff"]]
+            ),
+        )
+        self.assertEqual(self.backend.get_range("name/test", 0), b"suchgreatstuff")
+        self.assertEqual(list(self.backend.list_multipart("name/")), [])
+
+    def test_abort_multipart(self):
+        upload_id = self.backend.create_multipart("test", "")
+        self.backend.upload_part("test", upload_id, 1, b"such")
+        self.backend.abort_multipart("test", upload_id)
+
+        self.assertEqual(list(self.backend.list_multipart("")), [])
+        self.assertIsNone(self.backend.stat("test"))
+
+
+class TestOpenBackend(unittest.TestCase):
+    def test_s3_url(self):
+        backend, name = open_backend("s3://bucket/some/name")
+        self.assertEqual(backend.bucket, "bucket")
+        self.assertEqual(name, "some/name")
+
+    def test_file_url(self):
+        backend, name = open_backend("file:///mnt/nas/name")
+        self.assertEqual(backend.root, "/mnt/nas")
+        self.assertEqual(name, "name")
+
+    def test_invalid_url(self):
+        with self.assertRaises(RuntimeError):
+            open_backend("ftp://host/name")
+
+
+if __name__ == "__main__":
+    unittest.main()
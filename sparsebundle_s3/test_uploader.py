@@ -0,0 +1,248 @@
+import unittest
+import glob
+import os
+import tempfile
+
+from arc.common import FLAG_AES_GCM
+from arc.crypto import MemberCipher
+from arc.unarchiver import Unarchiver
+from sparsebundle_s3.bandreader import BandReader
+from sparsebundle_s3.storage import LocalBackend
+from sparsebundle_s3.uploader import Uploader
+
+KEY = bytes(range(32))
+OTHER_KEY = bytes(range(1, 33))
+
+
+class FlakyBackend(LocalBackend):
+    """LocalBackend that fails after a given number of uploaded parts."""
+
+    def __init__(self, root, parts_before_failure=None):
+        super().__init__(root)
+        self.parts_before_failure = parts_before_failure
+        self.uploaded_parts = []
+
+    def upload_part(self, key, upload_id, part_number, data):
+        if self.parts_before_failure is not None:
+            if len(self.uploaded_parts) == self.parts_before_failure:
+                raise RuntimeError("Simulated network failure.")
+
+        self.uploaded_parts.append(part_number)
+        return super().upload_part(key, upload_id, part_number, data)
+
+
+class RecordingBandReader(BandReader):
+    """BandReader that keeps every band file it opens."""
+
+    def __init__(self):
+        super().__init__()
+        self.files = []
+
+    def open(self, path):
+        file = super().open(path)
+        self.files.append(file)
+        return file
+
+
+def read_all(file, chunk_size=8192):
+    content = b""
+    while True:
+        chunk = file.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        content += chunk
+    return content
+
+
+class BundleFixture:
+    """Test case mixin creating a sparse bundle in a temporary directory,
+    along with a temporary directory and a destination to upload it to."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.bundle = os.path.join(self.tempdir.name, "test.sparsebundle")
+        self.outdir = os.path.join(self.tempdir.name, "tmp")
+        self.dest = os.path.join(self.tempdir.name, "dest")
+
+        os.makedirs(os.path.join(self.bundle, "bands"))
+        os.makedirs(self.outdir)
+
+        self._write_meta("Info.plist", b"plist")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _write_meta(self, filename, content):
+        with open(os.path.join(self.bundle, filename), "wb") as file:
+            file.write(content)
+
+    def _write_band(self, band, content):
+        with open(os.path.join(self.bundle, "bands", format(band, "x")), "wb") as file:
+            file.write(content)
+
+    def _uploader(self, backend, package_count=0x100, lz4=False, key=None, **kwargs):
+        """Returns an uploader of the bundle to `backend` under `test`,
+        encrypting with AES-GCM if a `key` is given. Other options of
+        `Uploader` are passed through, with small parts by default and
+        split blocks compressed on two threads."""
+        bundle_files = glob.glob(os.path.join(self.bundle, "**"), recursive=True)
+        kwargs.setdefault("part_size", 1000)
+        kwargs.setdefault("block_jobs", 2)
+        if key is not None:
+            kwargs["cipher"] = MemberCipher(FLAG_AES_GCM, key)
+
+        return Uploader(
+            self.bundle,
+            bundle_files,
+            package_count,
+            False,
+            lz4,
+            False,
+            self.outdir,
+            backend,
+            "test",
+            "STANDARD",
+            True,
+            **kwargs
+        )
+
+
+class TestUploader(BundleFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.bands = {}
+        for band in range(8):
+            content = bytes([band]) * 1000
+            self.bands[format(band, "x")] = content
+            self._write_band(band, content)
+
+    def _check_package(self, backend, key=None):
+        with open(os.path.join(self.dest, "test", "bands", "0-ff.arc"), "rb") as file:
+            files = Unarchiver(file, key).files()
+            self.assertEqual(
+                {name: read_all(content) for name, content in files}, self.bands
+            )
+
+        self.assertEqual(list(backend.list_multipart("")), [])
+
+    def test_multipart_upload(self):
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend).upload()
+
+        self.assertEqual(backend.uploaded_parts, list(range(1, 10)))
+        self._check_package(backend)
+
+    def test_resume_after_failure(self):
+        backend = FlakyBackend(self.dest, parts_before_failure=4)
+        with self.assertRaises(RuntimeError):
+            self._uploader(backend).upload()
+
+        self.assertEqual(len(list(backend.list_multipart(""))), 1)
+
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend).upload()
+
+        self.assertEqual(backend.uploaded_parts, list(range(5, 10)))
+        self._check_package(backend)
+
+    def test_restart_after_band_change(self):
+        backend = FlakyBackend(self.dest, parts_before_failure=4)
+        with self.assertRaises(RuntimeError):
+            self._uploader(backend).upload()
+
+        self.bands["3"] = b"changed" * 100
+        with open(os.path.join(self.bundle, "bands", "3"), "wb") as file:
+            file.write(self.bands["3"])
+
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend).upload()
+
+        self.assertEqual(backend.uploaded_parts, list(range(1, 9)))
+        self._check_package(backend)
+
+    def test_restart_after_key_change(self):
+        backend = FlakyBackend(self.dest, parts_before_failure=4)
+        with self.assertRaises(RuntimeError):
+            self._uploader(backend, key=KEY).upload()
+
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, key=OTHER_KEY).upload()
+
+        self.assertEqual(backend.uploaded_parts[0], 1)
+        self._check_package(backend, OTHER_KEY)
+
+    def test_failed_package_closes_bands(self):
+        backend = FlakyBackend(self.dest, parts_before_failure=0)
+        uploader = self._uploader(backend, block_size=256)
+        uploader.band_reader = RecordingBandReader()
+
+        packages = uploader.prepare()
+        with self.assertRaises(RuntimeError):
+            uploader.upload_package(0, packages[0])
+
+        self.assertEqual(len(uploader.band_reader.files), len(self.bands))
+        for file in uploader.band_reader.files:
+            self.assertIsNone(file.fd)
+
+    def test_abort_unknown_upload(self):
+        backend = FlakyBackend(self.dest)
+        backend.create_multipart("test/bands/100-1ff.arc", "STANDARD")
+
+        self._uploader(backend).upload()
+
+        self._check_package(backend)
+
+    def test_chunked_upload(self):
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, chunked=True).upload()
+
+        self.assertEqual(backend.uploaded_parts, list(range(1, 10)))
+        self._check_package(backend)
+
+        # Unchanged packages are recognized without reading them.
+        backend = FlakyBackend(self.dest)
+        uploader = self._uploader(backend, chunked=True)
+        uploader.upload()
+
+        self.assertEqual(backend.uploaded_parts, [])
+        self.assertEqual(uploader.stats["uploaded"], 0)
+
+    def test_chunked_key_change(self):
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, chunked=True, key=KEY).upload()
+
+        # The same bands under another key are not already uploaded.
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, chunked=True, key=OTHER_KEY).upload()
+
+        self.assertNotEqual(backend.uploaded_parts, [])
+        self._check_package(backend, OTHER_KEY)
+
+    def test_chunked_resume_after_failure(self):
+        backend = FlakyBackend(self.dest, parts_before_failure=4)
+        with self.assertRaises(RuntimeError):
+            self._uploader(backend, chunked=True).upload()
+
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, chunked=True).upload()
+
+        self.assertEqual(backend.uploaded_parts, list(range(5, 10)))
+        self._check_package(backend)
+
+    def test_split_upload(self):
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, block_size=256).upload()
+
+        self._check_package(backend)
+
+        # A different block size is different content.
+        backend = FlakyBackend(self.dest)
+        self._uploader(backend, block_size=512).upload()
+
+        self.assertNotEqual(backend.uploaded_parts, [])
+        self._check_package(backend)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+import os
+import threading
+import time
+
+from sparsebundle_s3.storage import LocalBackend
+from sparsebundle_s3.test_uploader import BundleFixture
+from sparsebundle_s3.watcher import IN_MODIFY, DirtyState, Watcher
+
+
+class FailingBackend(LocalBackend):
+    """LocalBackend whose uploads fail while `failing` is set."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.failing = False
+
+    def put(self, key, body, md5, storage_class):
+        if self.failing:
+            raise RuntimeError("Simulated network failure.")
+        return super().put(key, body, md5, storage_class)
+
+
+class TestWatcher(BundleFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.state_path = os.path.join(self.outdir, "dirty.json")
+
+        for band in range(8):
+            self._write_band(band, bytes([band]) * 100)
+
+        self.backend = FailingBackend(self.dest)
+
+    def _etag(self, key):
+        info = self.backend.stat(key)
+        return None if info is None else info.etag
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_first_start_rescans(self):
+        uploader = self._uploader(self.backend, 4)
+        uploader.start()
+        watcher = Watcher(uploader, self.state_path, 0)
+        self.assertTrue(watcher.state.rescan)
+
+        watcher.flush()
+
+        self.assertIsNotNone(self._etag("test/Info.plist"))
+        self.assertIsNotNone(self._etag("test/bands/0-3.arc"))
+        self.assertIsNotNone(self._etag("test/bands/4-7.arc"))
+        state = DirtyState(self.state_path)
+        self.assertTrue(state.load())
+        self.assertFalse(state.rescan)
+
+    def test_dirty_state_survives_restart(self):
+        uploader = self._uploader(self.backend, 4)
+        uploader.start()
+        watcher = Watcher(uploader, self.state_path, 3600)
+        watcher.flush()
+
+        watcher._handle([(watcher.bands_dir, IN_MODIFY, "5")])
+        self.assertFalse(watcher.flush())
+
+        # A new watcher finds the package still dirty, without rescanning.
+        uploader = self._uploader(self.backend, 4)
+        uploader.start()
+        watcher = Watcher(uploader, self.state_path, 0)
+        self.assertFalse(watcher.state.rescan)
+        self.assertEqual(list(watcher.state.packages), [1])
+
+        before = self._etag("test/bands/4-7.arc")
+        self._write_band(5, b"changed")
+        self.assertTrue(watcher.flush())
+
+        self.assertNotEqual(self._etag("test/bands/4-7.arc"), before)
+        state = DirtyState(self.state_path)
+        self.assertTrue(state.load())
+        self.assertEqual(state.packages, {})
+
+    def test_failed_uploads_stay_dirty(self):
+        uploader = self._uploader(self.backend, 4)
+        uploader.start()
+        watcher = Watcher(uploader, self.state_path, 0)
+        watcher.flush()
+
+        watcher._handle(
+            [
+                (watcher.bundle, IN_MODIFY, "Info.plist"),
+                (watcher.bands_dir, IN_MODIFY, "5"),
+            ]
+        )
+        self._write_meta("Info.plist", b"changed plist")
+        self._write_band(5, b"changed")
+
+        self.backend.failing = True
+        self.assertFalse(watcher.flush())
+
+        state = DirtyState(self.state_path)
+        self.assertTrue(state.load())
+        self.assertTrue(state.meta)
+        self.assertEqual(list(state.packages), [1])
+
+        self.backend.failing = False
+        self.assertTrue(watcher.flush())
+        self.assertFalse(watcher.state.meta)
+        self.assertEqual(watcher.state.packages, {})
+        with open(os.path.join(self.dest, "test", "Info.plist"), "rb") as file:
+            self.assertEqual(file.read(), b"changed plist")
+
+    def test_failed_package_does_not_block_others(self):
+        uploader = self._uploader(self.backend, 4)
+        uploader.start()
+        watcher = Watcher(uploader, self.state_path, 0)
+        watcher.flush()
+
+        watcher._handle(
+            [(watcher.bands_dir, IN_MODIFY, "1"), (watcher.bands_dir, IN_MODIFY, "5")]
+        )
+        self._write_band(1, b"changed")
+        self._write_band(5, b"changed")
+        before = self._etag("test/bands/4-7.arc")
+
+        upload_package = uploader.upload_package
+
+        def fail_first(package_id, bands):
+            if package_id == 0:
+                raise RuntimeError("Simulated failure.")
+            upload_package(package_id, bands)
+
+        uploader.upload_package = fail_first
+        self.assertTrue(watcher.flush())
+
+        self.assertNotEqual(self._etag("test/bands/4-7.arc"), before)
+        self.assertEqual(list(watcher.state.packages), [0])
+
+    def test_watch_uploads_changed_package(self):
+        uploader = self._uploader(self.backend, 4)
+        watcher = Watcher(uploader, self.state_path, 0.1)
+        watcher.POLL_INTERVAL = 0.05
+
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            self.assertTrue(
+                self._wait_for(lambda: self._etag("test/bands/4-7.arc") is not None)
+            )
+            self.assertTrue(self._wait_for(lambda: not watcher.state.rescan))
+
+            first = self._etag("test/bands/0-3.arc")
+            second = self._etag("test/bands/4-7.arc")
+            self._write_band(6, b"changed")
+
+            self.assertTrue(
+                self._wait_for(lambda: self._etag("test/bands/4-7.arc") != second)
+            )
+            self.assertEqual(self._etag("test/bands/0-3.arc"), first)
+        finally:
+            watcher.stop()
+            thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
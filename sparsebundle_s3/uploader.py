@@ -1,15 +1,23 @@
 import logging
 import os
+import io
 import hashlib
-import base64
+import threading
 
 from pathlib import Path
 
-import boto3
-import botocore
-
 import arc.archiver
 
+from .bandreader import BandReader
+from .catalog import Catalog
+from .journal import UploadJournal
+from .storage import multipart_etag
+
+# S3 refuses multipart uploads with more parts than this.
+MAX_PARTS = 10000
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
 
 def _calculate_md5(file):
     md5 = hashlib.md5()
@@ -19,6 +27,65 @@ def _calculate_md5(file):
     return md5
 
 
+def _calculate_digests(file, part_size):
+    """Returns the MD5 of the whole file together with the binary MD5 digests
+    of each of its `part_size` parts, computed in a single pass."""
+    md5 = hashlib.md5()
+    part_digests = []
+    part_md5 = hashlib.md5()
+    part_len = 0
+
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+        md5.update(chunk)
+
+        while chunk:
+            taken = chunk[: part_size - part_len]
+            part_md5.update(taken)
+            part_len += len(taken)
+            chunk = chunk[len(taken) :]
+
+            if part_len == part_size:
+                part_digests.append(part_md5.digest())
+                part_md5 = hashlib.md5()
+                part_len = 0
+
+    if part_len > 0:
+        part_digests.append(part_md5.digest())
+
+    return md5, part_digests
+
+
+def _get_size(file):
+    if hasattr(file, "__len__"):
+        return len(file)
+    else:
+        return os.fstat(file.fileno()).st_size
+
+
+def _read_part(file, size):
+    """Reads `size` bytes, or fewer at the end of the file."""
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_exactly(file, size):
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if len(chunk) == 0:
+            raise RuntimeError("Unexpected end of file while reading a part.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
 class Uploader:
     def __init__(
         self,
@@ -29,10 +96,19 @@ class Uploader:
         lz4,
         cache_chunks,
         outdir,
-        bucket,
+        backend,
         name,
         storage_class,
         for_real,
+        part_size=DEFAULT_PART_SIZE,
+        cache=None,
+        legacy_checksums=False,
+        cipher=None,
+        band_reader=None,
+        chunked=False,
+        block_size=None,
+        block_jobs=1,
+        block_executor=None,
     ):
         self.bundle = bundle
         self.bundle_files = bundle_files
@@ -41,45 +117,327 @@ class Uploader:
         self.lz4 = lz4
         self.cache_chunks = cache_chunks
         self.outdir = outdir
-        self.bucket = bucket
+        self.backend = backend
         self.name = name
         self.storage_class = storage_class
         self.for_real = for_real
+        self.part_size = part_size
+        self.cache = cache
+        self.legacy_checksums = legacy_checksums
+        self.cipher = cipher
+        self.band_reader = band_reader if band_reader is not None else BandReader()
+        self.chunked = chunked
+        self.block_size = block_size
+        self.block_jobs = block_jobs
+        self.block_executor = block_executor
+
+        self.journal = UploadJournal(os.path.join(outdir, "journal"))
+        # Fingerprints of completed streamed uploads, whose checksums are only
+        # known once they have been uploaded.
+        self.uploaded = UploadJournal(os.path.join(outdir, "uploaded"))
+        self.catalog = None
+
+        self.stats = {"files": 0, "uploaded": 0, "uploaded_bytes": 0}
+        self._stats_lock = threading.Lock()
 
         self.logger = logging.getLogger("uploader")
 
-    def _upload_file(self, local_file, remote, md5_catalog_path, storage_class):
+    def _upload_file(
+        self,
+        local_file,
+        remote,
+        catalog,
+        storage_class,
+        fingerprint=None,
+        uncompressed_size=None,
+    ):
+        size = _get_size(local_file)
+        if uncompressed_size is None:
+            uncompressed_size = size
+
+        if size > self.part_size:
+            etag = self._upload_multipart(
+                local_file, remote, storage_class, size, fingerprint
+            )
+        else:
+            etag = self._upload_single(local_file, remote, storage_class)
+
+        self._record_upload(remote, catalog, etag, size, uncompressed_size)
+
+    def _record_upload(self, remote, catalog, etag, size, uncompressed_size):
+        with self._stats_lock:
+            self.stats["files"] += 1
+            if etag is not None:
+                self.stats["uploaded"] += 1
+                self.stats["uploaded_bytes"] += size
+
+        if etag is not None and catalog is not None:
+            catalog.add(remote, etag, size, uncompressed_size)
+
+    def _upload_single(self, local_file, remote, storage_class):
+        """Uploads `local_file` in one request unless it is already there.
+        Returns its ETag if it was uploaded."""
         md5 = _calculate_md5(local_file)
 
-        try:
-            e_tag = boto3.resource("s3").Object(self.bucket, remote).e_tag
-            if e_tag[1:-1] == md5.hexdigest():
+        info = self.backend.stat(remote)
+        if info is not None:
+            if info.etag == md5.hexdigest():
                 self.logger.info("  File %s already uploaded.", remote)
-                return
+                return None
             else:
                 self.logger.warning("  File %s has a checksum mismatch.", remote)
-        except botocore.exceptions.ClientError:
-            pass
 
         if not self.for_real:
-            return
+            return None
 
         self.logger.info("  Starting to write to %s", remote)
 
-        try:
-            local_file.seek(0)
-            boto3.resource("s3").Bucket(self.bucket).put_object(
-                Key=remote,
-                Body=local_file,
-                StorageClass=storage_class,
-                ContentMD5=base64.b64encode(md5.digest()).decode(),
+        self.backend.put(remote, local_file, md5, storage_class)
+        return md5.hexdigest()
+
+    def _part_size_for(self, size):
+        return max(self.part_size, -(-size // MAX_PARTS))
+
+    def _upload_multipart(self, local_file, remote, storage_class, size, fingerprint):
+        """Uploads `local_file` in parts, recording every completed part in
+        the journal. Returns its ETag if it was uploaded.
+
+        An upload left behind by a previous run is resumed if its journal
+        entry matches the content: either by `fingerprint`, which skips
+        reading the content up front, or by MD5. Otherwise it is aborted and
+        the upload starts over."""
+        part_size = self._part_size_for(size)
+        entry = self.journal.load(remote)
+
+        if entry is not None and (
+            entry["size"] != size or entry["part_size"] != part_size
+        ):
+            self._abort_journaled(remote, entry)
+            entry = None
+
+        if (
+            entry is not None
+            and fingerprint is not None
+            and entry["fingerprint"] == fingerprint
+        ):
+            self.logger.info(
+                "  Resuming upload of %s after %d parts", remote, len(entry["parts"])
+            )
+        else:
+            md5, part_digests = _calculate_digests(local_file, part_size)
+            etag = multipart_etag(part_digests)
+
+            info = self.backend.stat(remote)
+            if info is not None:
+                if info.etag in (md5.hexdigest(), etag):
+                    self.logger.info("  File %s already uploaded.", remote)
+                    if entry is not None:
+                        self._abort_journaled(remote, entry)
+                    return None
+                else:
+                    self.logger.warning("  File %s has a checksum mismatch.", remote)
+
+            if entry is not None and entry["md5"] != md5.hexdigest():
+                self._abort_journaled(remote, entry)
+                entry = None
+
+            if entry is None and self.for_real:
+                self.logger.info("  Starting to write to %s", remote)
+                entry = {
+                    "remote": remote,
+                    "upload_id": self.backend.create_multipart(remote, storage_class),
+                    "size": size,
+                    "part_size": part_size,
+                    "fingerprint": fingerprint,
+                    "md5": md5.hexdigest(),
+                    "parts": [],
+                }
+                self.journal.save(remote, entry)
+
+        if not self.for_real:
+            return None
+
+        done = {part["number"] for part in entry["parts"]}
+        part_count = -(-size // part_size)
+
+        for number in range(1, part_count + 1):
+            if number in done:
+                continue
+
+            offset = (number - 1) * part_size
+            length = min(part_size, size - offset)
+
+            local_file.seek(offset)
+            data = _read_exactly(local_file, length)
+
+            self.logger.info("  Uploading part %d/%d of %s", number, part_count, remote)
+            part_etag = self.backend.upload_part(
+                remote, entry["upload_id"], number, data
+            )
+
+            entry["parts"].append(
+                {
+                    "number": number,
+                    "etag": part_etag,
+                    "offset": offset,
+                    "length": length,
+                }
+            )
+            self.journal.save(remote, entry)
+
+        parts = sorted((part["number"], part["etag"]) for part in entry["parts"])
+        self.backend.complete_multipart(remote, entry["upload_id"], parts)
+        self.journal.remove(remote)
+
+        return multipart_etag([bytes.fromhex(part_etag) for _, part_etag in parts])
+
+    def _upload_stream(
+        self, stream, remote, catalog, storage_class, fingerprint, uncompressed_size
+    ):
+        """Uploads a forward-only `stream` of unknown length, such as a chunked
+        archive, reading it exactly once.
+
+        As the checksum of the content is only known after reading it,
+        unchanged content is recognized by `fingerprint` alone. An interrupted
+        upload of the same content is resumed by regenerating the stream and
+        skipping the parts already uploaded, after checking that they match."""
+        done = self.uploaded.load(remote)
+        info = self.backend.stat(remote)
+        if (
+            done is not None
+            and info is not None
+            and done["fingerprint"] == fingerprint
+            and done["etag"] == info.etag
+        ):
+            self.logger.info("  File %s already uploaded.", remote)
+            self._record_upload(remote, catalog, None, info.size, uncompressed_size)
+            return
+
+        if info is not None:
+            self.logger.warning("  File %s has changed.", remote)
+
+        if not self.for_real:
+            self._record_upload(remote, catalog, None, 0, uncompressed_size)
+            return
+
+        # Archives are barely larger than their content, so twice its size is
+        # a safe bound for keeping within MAX_PARTS.
+        part_size = self._part_size_for(2 * uncompressed_size)
+        entry = self.journal.load(remote)
+        if entry is not None and (
+            entry["fingerprint"] != fingerprint or entry["part_size"] != part_size
+        ):
+            self._abort_journaled(remote, entry)
+            entry = None
+
+        data = _read_part(stream, part_size)
+        if len(data) < part_size and entry is None:
+            self.logger.info("  Starting to write to %s", remote)
+            md5 = hashlib.md5(data)
+            self.backend.put(remote, io.BytesIO(data), md5, storage_class)
+            etag = md5.hexdigest()
+            size = len(data)
+        else:
+            etag, size = self._upload_stream_parts(
+                stream, data, remote, storage_class, fingerprint, part_size, entry
             )
 
-            if md5_catalog_path is not None:
-                with open(md5_catalog_path, "a") as file:
-                    file.write("{} {}\n".format(md5.hexdigest(), remote))
-        except botocore.exceptions.ClientError as ex:
-            raise RuntimeError("Exception while uploading to S3: {}".format(ex))
+        self.uploaded.save(remote, {"fingerprint": fingerprint, "etag": etag})
+        self._record_upload(remote, catalog, etag, size, uncompressed_size)
+
+    def _upload_stream_parts(
+        self, stream, data, remote, storage_class, fingerprint, part_size, entry
+    ):
+        if entry is None:
+            self.logger.info("  Starting to write to %s", remote)
+            entry = {
+                "remote": remote,
+                "upload_id": self.backend.create_multipart(remote, storage_class),
+                "size": None,
+                "part_size": part_size,
+                "fingerprint": fingerprint,
+                "md5": None,
+                "parts": [],
+            }
+            self.journal.save(remote, entry)
+        else:
+            self.logger.info(
+                "  Resuming upload of %s after %d parts", remote, len(entry["parts"])
+            )
+
+        done = {part["number"]: part for part in entry["parts"]}
+        part_digests = []
+        number = 1
+        offset = 0
+
+        while data:
+            digest = hashlib.md5(data)
+
+            if number in done:
+                if done[number]["etag"] != digest.hexdigest():
+                    self._abort_journaled(remote, entry)
+                    raise RuntimeError(
+                        "Content of {} changed since its upload was "
+                        "interrupted.".format(remote)
+                    )
+            else:
+                self.logger.info("  Uploading part %d of %s", number, remote)
+                part_etag = self.backend.upload_part(
+                    remote, entry["upload_id"], number, data
+                )
+                entry["parts"].append(
+                    {
+                        "number": number,
+                        "etag": part_etag,
+                        "offset": offset,
+                        "length": len(data),
+                    }
+                )
+                self.journal.save(remote, entry)
+
+            part_digests.append(digest.digest())
+            offset += len(data)
+            number += 1
+            data = _read_part(stream, part_size)
+
+        parts = sorted((part["number"], part["etag"]) for part in entry["parts"])
+        self.backend.complete_multipart(remote, entry["upload_id"], parts)
+        self.journal.remove(remote)
+
+        return multipart_etag(part_digests), offset
+
+    def _abort_journaled(self, remote, entry):
+        if not self.for_real:
+            return
+
+        self.logger.info("  Aborting stale upload %s of %s", entry["upload_id"], remote)
+        try:
+            self.backend.abort_multipart(remote, entry["upload_id"])
+        except RuntimeError as ex:
+            self.logger.warning("  Failed to abort upload: %s", ex)
+        self.journal.remove(remote)
+
+    def _abort_stale_uploads(self):
+        """Aborts multipart uploads under our prefix that the journal does not
+        know about, and forgets journal entries for uploads that no longer
+        exist."""
+        if not self.for_real:
+            return
+
+        live = set()
+        for remote, upload_id in self.backend.list_multipart(self.name + "/"):
+            entry = self.journal.load(remote)
+            if entry is not None and entry["upload_id"] == upload_id:
+                live.add(remote)
+                continue
+
+            self.logger.info("Aborting stale upload %s of %s", upload_id, remote)
+            self.backend.abort_multipart(remote, upload_id)
+
+        for remote in self.journal.remotes():
+            if remote.startswith(self.name + "/") and remote not in live:
+                self.logger.info("Forgetting expired upload of %s", remote)
+                self.journal.remove(remote)
 
     def _find_meta_files(self):
         meta_list = []
@@ -96,8 +454,8 @@ class Uploader:
             meta_list.append(relpath)
         return meta_list
 
-    def _find_bands(self):
-        # Gather the list of bands
+    def find_bands(self):
+        """Returns the sorted numbers of the bands in `bundle_files`."""
         bands_dir = os.path.join(self.bundle, "bands")
         if not os.path.exists(bands_dir):
             raise RuntimeError(
@@ -128,7 +486,8 @@ class Uploader:
 
         return bands
 
-    def _build_package_manifests(self, bands):
+    def package_manifests(self, bands):
+        """Groups `bands` by package, mapping package IDs to their bands."""
         packages = {}
         for band in bands:
             package_id = band // self.package_count
@@ -137,53 +496,196 @@ class Uploader:
             packages[package_id].append(band)
         return packages
 
-    def upload(self):
-        md5_catalog_path = os.path.join(self.outdir, "checksums.txt")
+    def band_path(self, band):
+        return os.path.join(self.bundle, "bands", format(band, "x"))
 
+    def package_remote_path(self, package_id):
+        """Returns the key a package is uploaded to."""
+        name = "{}-{}".format(
+            format(package_id * self.package_count, "x"),
+            format((package_id + 1) * self.package_count - 1, "x"),
+        )
+        return "{}/bands/{}.arc".format(self.name, name)
+
+    def _package_fingerprint(self, band_files):
+        """Identifies a package's content by its codec, its encryption key and
+        the size and mtime of its bands, without reading them."""
+        fingerprint = hashlib.sha256()
+        fingerprint.update(
+            "{} {} {}{}{}{}\n".format(
+                self.gzip,
+                self.lz4,
+                self.cipher.flag if self.cipher else 0,
+                " key {}".format(self.cipher.key_id) if self.cipher else "",
+                " chunked" if self.chunked else "",
+                " split {}".format(self.block_size) if self.block_size else "",
+            ).encode()
+        )
+        for band_file in band_files:
+            stat = os.fstat(band_file.fileno())
+            fingerprint.update(
+                "{} {} {}\n".format(
+                    os.path.basename(band_file.name), stat.st_size, stat.st_mtime_ns
+                ).encode()
+            )
+        return fingerprint.hexdigest()
+
+    def _open_catalog(self):
+        catalog = Catalog(os.path.join(self.outdir, "catalog"))
+
+        legacy_path = os.path.join(self.outdir, "checksums.txt")
+        if (
+            catalog.base is None
+            and not catalog.segments
+            and os.path.exists(legacy_path)
+        ):
+            self.logger.info("Importing legacy checksum file %s", legacy_path)
+            catalog.import_text(legacy_path)
+
+        return catalog
+
+    def _upload_catalog(self, catalog):
+        catalog.flush()
+        if catalog.compact():
+            self.logger.info("Compacted checksum catalog")
+            paths = [catalog.base_path()]
+        else:
+            paths = [catalog.segment_path()]
+
+        for local in paths:
+            if local is None:
+                continue
+
+            remote = "{}/catalog/{}".format(self.name, os.path.basename(local))
+            self.logger.info("Uploading checksum catalog %s -> %s", local, remote)
+            with open(local, "rb") as file:
+                self._upload_file(file, remote, None, "STANDARD")
+
+        if self.legacy_checksums:
+            local = os.path.join(self.outdir, "checksums.txt")
+            with open(local, "w") as file:
+                catalog.export_text(file)
+
+            remote = "{}/checksums.txt".format(self.name)
+            self.logger.info("Uploading checksum file %s -> %s", local, remote)
+            with open(local, "rb") as file:
+                self._upload_file(file, remote, None, "STANDARD")
+
+    def package_bands(self, package_id):
+        """Lists the bands of a package that currently exist on disk, without
+        scanning the whole bands directory."""
+        bands = []
+        for band in range(
+            package_id * self.package_count, (package_id + 1) * self.package_count
+        ):
+            if os.path.exists(self.band_path(band)):
+                bands.append(band)
+        return bands
+
+    def start(self):
+        """Opens the checksum catalog and cleans up stale uploads. Must be
+        called before uploading anything."""
+        self.catalog = self._open_catalog()
+
+        self._abort_stale_uploads()
+
+    def upload_meta_files(self):
         self.logger.info("Uploading meta files")
         for meta in self._find_meta_files():
             local = os.path.join(self.bundle, meta)
             remote = "{}/{}".format(self.name, meta)
 
             self.logger.info("Uploading meta file %s -> %s", local, remote)
+            # Meta files are not encrypted, see the --encrypt help text.
             with open(local, "rb") as file:
-                self._upload_file(file, remote, md5_catalog_path, self.storage_class)
+                self._upload_file(file, remote, self.catalog, self.storage_class)
+
+    def prepare(self):
+        """Uploads the meta files and returns the package manifests, mapping
+        package IDs to their bands, for `upload_package`."""
+        self.start()
+        self.upload_meta_files()
 
-        bands = self._find_bands()
-        packages = self._build_package_manifests(bands)
+        bands = self.find_bands()
+        packages = self.package_manifests(bands)
         self.logger.info(
             "Found %d bands -- will build %d packages", len(bands), len(packages)
         )
 
-        for package_id in sorted(packages.keys()):
-            name = "{}-{}".format(
-                format(package_id * self.package_count, "x"),
-                format((package_id + 1) * self.package_count - 1, "x"),
-            )
-            remote_path = "{}/bands/{}.arc".format(self.name, name)
+        return packages
 
-            self.logger.info("Archiving package %s", remote_path)
-            archive = arc.archiver.Archiver(
-                use_gzip=self.gzip, use_lz4=self.lz4, cache_chunks=self.cache_chunks
-            )
-            band_files = []
-            for band in packages[package_id]:
+    def schedule_packages(self, packages):
+        """Lets the band reader prefetch the bands of `packages` in the order
+        `upload` uploads them."""
+        self.band_reader.schedule(
+            [
+                self.band_path(band)
+                for package_id in sorted(packages.keys())
+                for band in packages[package_id]
+            ]
+        )
+
+    def new_archiver(self, use_gzip=None, use_lz4=None):
+        """Returns an empty archive with the settings packages are uploaded
+        with, optionally with another codec."""
+        return arc.archiver.Archiver(
+            use_gzip=self.gzip if use_gzip is None else use_gzip,
+            use_lz4=self.lz4 if use_lz4 is None else use_lz4,
+            cache_chunks=self.cache_chunks,
+            cache=self.cache,
+            cipher=self.cipher,
+            chunked=self.chunked,
+            block_size=self.block_size,
+            block_jobs=self.block_jobs,
+            executor=self.block_executor,
+        )
+
+    def upload_package(self, package_id, bands):
+        remote_path = self.package_remote_path(package_id)
+
+        self.logger.info("Archiving package %s", remote_path)
+        archive = self.new_archiver()
+        band_files = []
+        try:
+            for band in bands:
                 band_name = format(band, "x")
-                band_path = os.path.join(self.bundle, "bands", band_name)
-                band_file = open(band_path, "rb")
+                band_file = self.band_reader.open(self.band_path(band))
                 band_files.append(band_file)
                 archive.add_file(band_name, band_file)
 
             self.logger.info("  Uploading package %s", remote_path)
-            self._upload_file(
-                archive, remote_path, md5_catalog_path, self.storage_class
+            upload = self._upload_stream if self.chunked else self._upload_file
+            upload(
+                archive,
+                remote_path,
+                self.catalog,
+                self.storage_class,
+                self._package_fingerprint(band_files),
+                sum(os.fstat(file.fileno()).st_size for file in band_files),
             )
-
+        finally:
+            # Batch and watch modes carry on after a failed package.
+            archive.release()
             for file in band_files:
                 file.close()
 
-        local = os.path.join(md5_catalog_path)
-        remote = "{}/checksums.txt".format(self.name)
-        self.logger.info("Uploading checksum file %s -> %s", local, remote)
-        with open(local, "rb") as file:
-            self._upload_file(file, remote, None, "STANDARD")
+    def finish(self):
+        """Uploads the checksum catalog once all packages are done."""
+        self._upload_catalog(self.catalog)
+
+    def upload(self):
+        packages = self.prepare()
+
+        self.schedule_packages(packages)
+
+        for package_id in sorted(packages.keys()):
+            self.upload_package(package_id, packages[package_id])
+
+        if self.cache is not None:
+            self.logger.info(
+                "Chunk cache: %(hits)d hits, %(misses)d misses, "
+                "%(evictions)d evictions, %(spills)d spills",
+                self.cache.stats(),
+            )
+
+        self.finish()
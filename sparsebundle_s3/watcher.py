@@ -0,0 +1,354 @@
+import logging
+import os
+import json
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal ctypes binding of Linux inotify."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise RuntimeError("inotify is not available on this platform.")
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise RuntimeError("inotify_init1 failed: {}".format(os.strerror(errno)))
+
+        self.paths = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise RuntimeError(
+                "Failed to watch {}: {}".format(path, os.strerror(errno))
+            )
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout):
+        """Returns `(path, mask, name)` for every event that arrives within
+        `timeout` seconds. `name` is empty for events on a watched directory
+        itself."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + name_len].rstrip(b"\x00").decode()
+            offset += name_len
+            events.append((self.paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirtyState:
+    """Durable record of what needs uploading.
+
+    Maps dirty package IDs to the time of their last change, and flags
+    changed meta files and whether a full rescan is due. The state is
+    rewritten atomically whenever a package becomes dirty or clean, so that a
+    restarted watcher picks up where the last one stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.packages = {}
+        self.meta = False
+        self.rescan = True
+
+    def load(self):
+        """Loads the saved state. Returns False if there is none, in which case
+        a full rescan is due."""
+        try:
+            with open(self.path, "rb") as file:
+                state = json.loads(file.read().decode())
+        except FileNotFoundError:
+            return False
+
+        self.packages = {
+            int(package_id): changed
+            for package_id, changed in state["packages"].items()
+        }
+        self.meta = state["meta"]
+        self.rescan = state["rescan"]
+        return True
+
+    def save(self):
+        state = {
+            "packages": {
+                str(package_id): changed
+                for package_id, changed in self.packages.items()
+            },
+            "meta": self.meta,
+            "rescan": self.rescan,
+        }
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(json.dumps(state, sort_keys=True).encode())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class Watcher:
+    """Continuously uploads the packages of a bundle as its bands change.
+
+    Changes to `<bundle>/bands/` are tracked with inotify and coalesced into
+    dirty package IDs, which are uploaded once they have been quiet for
+    `debounce` seconds. With a non-zero `interval`, dirty packages are only
+    uploaded every `interval` seconds instead.
+
+    The dirty set survives restarts, but changes made while no watcher is
+    running are not seen; pass `rescan=True` after such a gap. A full rescan
+    is also done on the first start and when the kernel's event queue
+    overflows."""
+
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, uploader, state_path, debounce, interval=0, rescan=False):
+        self.uploader = uploader
+        self.bundle = uploader.bundle
+        self.bands_dir = os.path.join(self.bundle, "bands")
+        self.debounce = debounce
+        self.interval = interval
+
+        self.state = DirtyState(state_path)
+        if self.state.load() and rescan:
+            self.state.rescan = True
+
+        self.logger = logging.getLogger("watcher")
+        self.stopped = threading.Event()
+        self.inotify = None
+        self.retry_at = 0
+
+    def _band_package(self, name):
+        try:
+            band = int(name, 16)
+        except ValueError:
+            return None
+        if name != format(band, "x"):
+            return None
+        return band // self.uploader.package_count
+
+    def _handle(self, events):
+        changed = False
+        now = time.time()
+
+        for path, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed -- will rescan")
+                changed = changed or not self.state.rescan
+                self.state.rescan = True
+            elif mask & IN_DELETE_SELF:
+                raise RuntimeError("Watched directory {} was removed.".format(path))
+            elif path == self.bands_dir:
+                package_id = self._band_package(name)
+                if package_id is None:
+                    continue
+                if package_id not in self.state.packages:
+                    changed = True
+                self.state.packages[package_id] = now
+            elif path == self.bundle and name and name != "bands":
+                if mask & IN_ISDIR:
+                    continue
+                changed = changed or not self.state.meta
+                self.state.meta = True
+
+        if changed:
+            self.state.save()
+
+    def _drain(self):
+        if self.inotify is not None:
+            self._handle(self.inotify.read(0))
+
+    def _meta_files(self):
+        files = []
+        for root, dirs, filenames in os.walk(self.bundle):
+            if root == self.bundle and "bands" in dirs:
+                dirs.remove("bands")
+            files.extend(os.path.join(root, filename) for filename in filenames)
+        return files
+
+    def _rescan(self):
+        self.logger.info("Rescanning the whole bundle")
+        start = time.time()
+        self.uploader.bundle_files = self._meta_files() + [
+            os.path.join(self.bands_dir, name) for name in os.listdir(self.bands_dir)
+        ]
+        packages = self.uploader.package_manifests(self.uploader.find_bands())
+
+        self.uploader.upload_meta_files()
+        self.uploader.schedule_packages(packages)
+        for package_id in sorted(packages.keys()):
+            self.uploader.upload_package(package_id, packages[package_id])
+            self._drain()
+
+        # Everything changed up to the start of the rescan is now uploaded.
+        self.state.packages = {
+            package_id: changed
+            for package_id, changed in self.state.packages.items()
+            if changed >= start
+        }
+        self.state.meta = False
+        self.state.rescan = False
+        self.state.save()
+
+    def _upload_meta(self):
+        self.uploader.bundle_files = self._meta_files()
+        self.uploader.upload_meta_files()
+
+        # Changes made during the upload are only handled afterwards, and
+        # set the flag again.
+        self.state.meta = False
+        self.state.save()
+
+    def _upload_dirty(self, now):
+        ready = sorted(
+            package_id
+            for package_id, changed in self.state.packages.items()
+            if now - changed >= self.debounce
+        )
+
+        packages = {
+            package_id: self.uploader.package_bands(package_id) for package_id in ready
+        }
+        self.uploader.schedule_packages(packages)
+
+        failed = 0
+        for package_id in ready:
+            changed = self.state.packages[package_id]
+            bands = packages[package_id]
+            if bands:
+                try:
+                    self.uploader.upload_package(package_id, bands)
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.error(
+                        "Package %s failed -- retrying in %ds",
+                        format(package_id, "x"),
+                        self.debounce,
+                        exc_info=True,
+                    )
+                    # Stays dirty, and is retried once debounced again.
+                    self.state.packages[package_id] = max(
+                        now, self.state.packages[package_id]
+                    )
+                    self.state.save()
+                    self._drain()
+                    failed += 1
+                    continue
+            else:
+                self.logger.warning(
+                    "Package %s has no bands left -- keeping the uploaded one",
+                    format(package_id, "x"),
+                )
+
+            self._drain()
+            if self.state.packages.get(package_id) == changed:
+                del self.state.packages[package_id]
+                self.state.save()
+
+        return len(ready) - failed
+
+    def flush(self, now=None):
+        """Uploads everything that is due. Returns whether anything was.
+
+        Failures are logged rather than raised, and what failed stays dirty
+        to be retried after the debounce delay."""
+        if now is None:
+            now = time.time()
+        if now < self.retry_at:
+            return False
+
+        try:
+            if self.state.rescan:
+                self._rescan()
+                uploaded = True
+            else:
+                uploaded = self.state.meta
+                if self.state.meta:
+                    self._upload_meta()
+                uploaded = self._upload_dirty(now) > 0 or uploaded
+
+            if uploaded:
+                self.uploader.finish()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.error(
+                "Upload failed -- retrying in %ds", self.debounce, exc_info=True
+            )
+            self.retry_at = now + self.debounce
+            return False
+
+        return uploaded
+
+    def run(self):
+        self.inotify = Inotify()
+        try:
+            self.inotify.add_watch(self.bands_dir)
+            self.inotify.add_watch(self.bundle)
+
+            self.uploader.start()
+
+            self.logger.info(
+                "Watching %s -- %d dirty packages",
+                self.bands_dir,
+                len(self.state.packages),
+            )
+
+            next_flush = time.time() + self.interval
+            while not self.stopped.is_set():
+                self._handle(self.inotify.read(self.POLL_INTERVAL))
+
+                now = time.time()
+                if self.state.rescan or now >= next_flush:
+                    self.flush(now)
+                    if self.interval > 0:
+                        next_flush = now + self.interval
+        finally:
+            self.inotify.close()
+
+    def stop(self):
+        self.stopped.set()